@@ -0,0 +1,6 @@
+from neutron_isoflat.common import constants
+
+
+def get_agent_topic(physical_network):
+    """Topic the agents serving a physical network consume updates on."""
+    return '%s.%s' % (constants.TOPIC_ISOFLAT_AGENT, physical_network)
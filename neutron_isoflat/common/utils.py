@@ -0,0 +1,14 @@
+import hashlib
+import json
+
+
+def get_rules_digest(isoflat_rules):
+    """
+    Digest of isoflat rules as sent to the agents.
+
+    Neither the order of the rules nor of their remote IPs matters, so the
+    server and the agents get the same digest for the same rules.
+    """
+    rules = sorted((dict(rule, remote_ips=sorted(rule['remote_ips'])) for rule in isoflat_rules),
+                   key=lambda rule: rule['id'])
+    return hashlib.sha256(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest()
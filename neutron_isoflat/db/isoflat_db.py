@@ -1,3 +1,5 @@
+import collections
+
 from neutron.db import common_db_mixin as base_db
 from neutron.db.models.segment import NetworkSegment
 from neutron.db.models_v2 import Subnet, Network
@@ -6,7 +8,7 @@ from oslo_log import log as logging
 from oslo_utils import uuidutils
 from sqlalchemy.orm import exc
 
-from neutron_isoflat.db.models.isoflat import IsoflatRule
+from neutron_isoflat.db.models.isoflat import IsoflatGeneration, IsoflatRule
 from neutron_isoflat.extensions import isoflat
 
 LOG = logging.getLogger(__name__)
@@ -25,8 +27,20 @@ class IsoflatDbMixin(isoflat.IsoflatPluginBase, base_db.CommonDbMixin):
         return network
 
     @staticmethod
-    def _get_subnets(context, network_id):
-        return context.session.query(Subnet).filter_by(network_id=network_id).all()
+    def _get_subnet_cidrs_by_network(context, network_ids):
+        """
+        Get the subnet CIDRs of many networks in a single query.
+
+        :returns: a dict of network id -> list of CIDRs
+        """
+        cidrs = collections.defaultdict(list)
+        if not network_ids:
+            return cidrs
+        query = context.session.query(Subnet.network_id, Subnet.cidr).filter(
+            Subnet.network_id.in_(network_ids))
+        for network_id, cidr in query:
+            cidrs[network_id].append(cidr)
+        return cidrs
 
     def _get_rule(self, context, id):
         try:
@@ -35,16 +49,106 @@ class IsoflatDbMixin(isoflat.IsoflatPluginBase, base_db.CommonDbMixin):
             raise isoflat.IsoflatRuleNotFound(rule_id=id)
 
     @staticmethod
-    def _get_rules_by_network(context, network_id):
-        return context.session.query(IsoflatRule).filter_by(network_id=network_id).all()
+    def _get_rules_to_delete(context, network_id=None, rule_ids=None):
+        """
+        Get the rules of a network, the rules with the given IDs or both.
+
+        :raises IsoflatRuleNotFound: if a given rule does not exist or is
+            not a rule of the network
+        """
+        query = context.session.query(IsoflatRule)
+        if network_id is not None:
+            query = query.filter(IsoflatRule.network_id == network_id)
+        if rule_ids:
+            query = query.filter(IsoflatRule.id.in_(rule_ids))
+        rules = query.all()
+        for rule_id in set(rule_ids or []) - set(rule['id'] for rule in rules):
+            raise isoflat.IsoflatRuleNotFound(rule_id=rule_id)
+        return rules
 
     @staticmethod
     def _get_rules_by_physical_network(context, physical_network):
-        segment = context.session.query(NetworkSegment).filter_by(physical_network=physical_network,
-                                                                  network_type='flat').first()
-        if not segment:
-            return []
-        return IsoflatDbMixin._get_rules_by_network(context, segment['network_id'])
+        query = context.session.query(IsoflatRule).join(
+            NetworkSegment, NetworkSegment.network_id == IsoflatRule.network_id)
+        return query.filter(NetworkSegment.physical_network == physical_network,
+                            NetworkSegment.network_type == 'flat').all()
+
+    @staticmethod
+    def _get_rules_by_remote_network(context, network_id):
+        """
+        Get the rules which take their remote IPs from the subnets of a network.
+
+        :returns: a dict of physical network -> rules
+        """
+        query = context.session.query(NetworkSegment.physical_network, IsoflatRule).join(
+            IsoflatRule, NetworkSegment.network_id == IsoflatRule.network_id)
+        query = query.filter(IsoflatRule.remote_network_id == network_id,
+                             IsoflatRule.remote_ip.is_(None),
+                             NetworkSegment.network_type == 'flat')
+        rules = collections.defaultdict(list)
+        for physical_network, rule in query:
+            rules[physical_network].append(rule)
+        return rules
+
+    @staticmethod
+    def _get_physical_network(context, network_id):
+        """Get the physical network of a flat network, None for other networks."""
+        segment = context.session.query(NetworkSegment.physical_network).filter_by(
+            network_id=network_id, network_type='flat').first()
+        return segment.physical_network if segment else None
+
+    @staticmethod
+    def _get_rules_by_deleted_network(context, network_id, physical_network):
+        """
+        Get the rules deleting a network takes along, its own rules and the
+        rules taking their remote IPs from it.
+
+        The segments of the deleted network may be gone already, so its
+        physical network is passed in.
+
+        :returns: a dict of physical network -> rules
+        """
+        rules = collections.defaultdict(list)
+        if physical_network is not None:
+            rules[physical_network] = context.session.query(IsoflatRule).filter_by(
+                network_id=network_id).all()
+        query = context.session.query(NetworkSegment.physical_network, IsoflatRule).join(
+            IsoflatRule, NetworkSegment.network_id == IsoflatRule.network_id)
+        query = query.filter(IsoflatRule.remote_network_id == network_id,
+                             IsoflatRule.network_id != network_id,
+                             NetworkSegment.network_type == 'flat')
+        for physical_network, rule in query:
+            rules[physical_network].append(rule)
+        return dict((physical_network, physical_network_rules)
+                    for physical_network, physical_network_rules in rules.items()
+                    if physical_network_rules)
+
+    @staticmethod
+    def _get_generation(context, physical_network):
+        generation = context.session.query(IsoflatGeneration).filter_by(
+            physical_network=physical_network).first()
+        return generation['generation'] if generation else 0
+
+    @staticmethod
+    def _bump_generation(context, physical_network):
+        """
+        Move the rules of a physical network to the next generation.
+
+        Has to be called in the transaction changing the rules, the row lock
+        keeps concurrent changes from sharing a generation. The row of a
+        physical network is added by its first change. Concurrent first
+        changes fail with a deadlock, locking the gap of the missing row on
+        MySQL, or a duplicate entry; the API calls changing rules are retried
+        on both.
+        """
+        with context.session.begin(subtransactions=True):
+            generation = context.session.query(IsoflatGeneration).filter_by(
+                physical_network=physical_network).with_for_update().first()
+            if generation is None:
+                generation = IsoflatGeneration(physical_network=physical_network, generation=0)
+                context.session.add(generation)
+            generation.generation += 1
+        return generation.generation
 
     def _make_rule_dict(self, rule, fields=None):
         res = {
@@ -0,0 +1,14 @@
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'isoflat_generations'
+down_revision = 'init_neutron_isoflat'
+
+
+def upgrade():
+    op.create_table(
+        'isoflatgenerations',
+        sa.Column('physical_network', sa.String(length=64), nullable=False),
+        sa.Column('generation', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('physical_network'))
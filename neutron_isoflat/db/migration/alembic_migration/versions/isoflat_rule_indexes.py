@@ -0,0 +1,14 @@
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'isoflat_rule_indexes'
+down_revision = 'isoflat_generations'
+
+
+def upgrade():
+    # rules of a network, and the join from segments to their rules
+    op.create_index('ix_isoflatrules_network_id_remote_network_id', 'isoflatrules',
+                    ['network_id', 'remote_network_id'])
+    # rules to refresh when the subnets of a remote network change
+    op.create_index('ix_isoflatrules_remote_network_id_network_id', 'isoflatrules',
+                    ['remote_network_id', 'network_id'])
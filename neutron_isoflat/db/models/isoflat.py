@@ -12,6 +12,13 @@ class IsoflatRule(standard_attr.HasStandardAttributes, model_base.BASEV2, model_
     """Represents a v2 neutron isoflat rule."""
 
     __tablename__ = 'isoflatrules'
+    __table_args__ = (
+        sa.Index('ix_isoflatrules_network_id_remote_network_id',
+                 'network_id', 'remote_network_id'),
+        sa.Index('ix_isoflatrules_remote_network_id_network_id',
+                 'remote_network_id', 'network_id'),
+        model_base.BASEV2.__table_args__
+    )
     network_id = sa.Column(sa.String(length=db_const.UUID_FIELD_SIZE),
                            sa.ForeignKey("networks.id", ondelete="CASCADE"),
                            nullable=False)
@@ -35,3 +42,11 @@ class IsoflatRule(standard_attr.HasStandardAttributes, model_base.BASEV2, model_
         Network,
         primaryjoin="Network.id==IsoflatRule.remote_network_id")
     api_collections = ['isoflat_rules']
+
+
+class IsoflatGeneration(model_base.BASEV2):
+    """Represents the generation of the isoflat rules of a physical network."""
+
+    __tablename__ = 'isoflatgenerations'
+    physical_network = sa.Column(sa.String(length=64), primary_key=True)
+    generation = sa.Column(sa.BigInteger(), nullable=False, default=0)
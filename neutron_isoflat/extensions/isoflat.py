@@ -9,6 +9,7 @@ from neutron.extensions.securitygroup import convert_validate_port_value
 from neutron.extensions.securitygroup import sg_supported_ethertypes
 from neutron_lib import constants as qconstants
 from neutron_lib import exceptions as qexception
+from neutron_lib.api import converters
 from neutron_lib.api import extensions
 from neutron_lib.services import base as service_base
 
@@ -53,7 +54,21 @@ RESOURCE_ATTRIBUTE_MAP = {
                         'validate': {
                             'type:string': constants.DESCRIPTION_FIELD_SIZE},
                         'is_visible': True, 'default': ''},
-    }
+    },
+    # deletes many rules at once, the rules of a network or listed by id;
+    # a deletion is carried out right away and not kept, so it has no id
+    'rule_deletions': {
+        'tenant_id': {'allow_post': True, 'allow_put': False,
+                      'validate': {'type:string': None},
+                      'required_by_policy': True, 'is_visible': True},
+        'network_id': {'allow_post': True, 'allow_put': False,
+                       'validate': {'type:uuid_or_none': None},
+                       'default': None, 'is_visible': True},
+        'rule_ids': {'allow_post': True, 'allow_put': False,
+                     'convert_to': converters.convert_none_to_empty_list,
+                     'validate': {'type:uuid_list': None},
+                     'default': [], 'is_visible': True},
+    },
 }
 
 
@@ -69,6 +84,14 @@ class InvalidNetworkType(qexception.Invalid):
     message = _("The specified network %(network_id)s is not a flat network")
 
 
+class IsoflatRuleDeletionNotFound(qexception.NotFound):
+    message = _("Isoflat rule deletion %(rule_deletion_id)s does not exist")
+
+
+class NoRulesToDelete(qexception.Invalid):
+    message = _("Either a network or the IDs of the rules to delete must be given")
+
+
 # Class name here has to be lowercase except the initial letter
 class Isoflat(extensions.ExtensionDescriptor):
 
@@ -98,11 +121,20 @@ class Isoflat(extensions.ExtensionDescriptor):
         plural_mappings = resource_helper.build_plural_mappings(
             {}, RESOURCE_ATTRIBUTE_MAP)
 
-        return resource_helper.build_resource_info(plural_mappings,
-                                                   RESOURCE_ATTRIBUTE_MAP,
-                                                   constants.ISOFLAT,
-                                                   translate_name=False,
-                                                   allow_bulk=True)
+        rule_map = {'rules': RESOURCE_ATTRIBUTE_MAP['rules']}
+        rule_deletion_map = {'rule_deletions': RESOURCE_ATTRIBUTE_MAP['rule_deletions']}
+
+        # a rule deletion already deletes many rules, so it has no bulk form
+        return (resource_helper.build_resource_info(plural_mappings,
+                                                    rule_map,
+                                                    constants.ISOFLAT,
+                                                    translate_name=False,
+                                                    allow_bulk=True) +
+                resource_helper.build_resource_info(plural_mappings,
+                                                    rule_deletion_map,
+                                                    constants.ISOFLAT,
+                                                    translate_name=False,
+                                                    allow_bulk=False))
 
     def update_attributes_map(self, attributes):
         super(Isoflat, self).update_attributes_map(
@@ -149,3 +181,20 @@ class IsoflatPluginBase(service_base.ServicePluginBase):
     def delete_rule(self, context, rule_id):
         """Delete an Isoflat rule."""
         pass
+
+    @abc.abstractmethod
+    def create_rule_deletion(self, context, rule_deletion):
+        """Delete the Isoflat rules of a network or with the given IDs."""
+        pass
+
+    @abc.abstractmethod
+    def get_rule_deletions(self, context, filters=None, fields=None,
+                           sorts=None, limit=None, marker=None,
+                           page_reverse=False):
+        """List Isoflat rule deletions."""
+        pass
+
+    @abc.abstractmethod
+    def get_rule_deletion(self, context, rule_deletion_id, fields=None):
+        """Get an Isoflat rule deletion."""
+        pass
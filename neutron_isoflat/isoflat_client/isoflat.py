@@ -1,4 +1,7 @@
+from __future__ import print_function
+
 from neutronclient._i18n import _
+from neutronclient.common import exceptions
 from neutronclient.common import extension
 from neutronclient.common import utils
 from neutronclient.neutron import v2_0 as neutronV20
@@ -24,6 +27,14 @@ class IsoflatRule(extension.NeutronClientExtension):
     versions = ['2.0']
 
 
+class IsoflatRuleDeletion(extension.NeutronClientExtension):
+    resource = 'rule_deletion'
+    resource_plural = '%ss' % resource
+    object_path = '/isoflat/%s' % resource_plural
+    resource_path = '/isoflat/%s/%%s' % resource_plural
+    versions = ['2.0']
+
+
 class ListIsoflatRule(extension.ClientExtensionList, IsoflatRule):
     """List Isoflat rules."""
 
@@ -41,10 +52,38 @@ class ListIsoflatRule(extension.ClientExtensionList, IsoflatRule):
 
 
 class DeleteIsoflatRule(extension.ClientExtensionDelete, IsoflatRule):
-    """Delete an Isoflat rule."""
+    """Delete Isoflat rules by ID or all the Isoflat rules of a network."""
 
     shell_command = 'isoflat-rule-delete'
 
+    def get_parser(self, prog_name):
+        parser = neutronV20.NeutronCommand.get_parser(self, prog_name)
+        parser.add_argument(
+            'id', metavar='RULE', nargs='*',
+            help=_('ID(s) of the Isoflat rule(s) to delete.'))
+        parser.add_argument(
+            '--network', metavar='NETWORK',
+            help=_('Delete all the Isoflat rules of this network. Given '
+                   'together with rule IDs, the rules must belong to it.'))
+        return parser
+
+    def take_action(self, parsed_args):
+        if not parsed_args.id and not parsed_args.network:
+            raise exceptions.CommandError(
+                _('Give the IDs of the rules to delete or a network.'))
+        neutron_client = self.get_client()
+        body = {'rule_ids': parsed_args.id}
+        if parsed_args.network:
+            body['network_id'] = neutronV20.find_resourceid_by_name_or_id(
+                neutron_client, 'network', parsed_args.network)
+        # all the rules go in a single request
+        result = neutron_client.post(IsoflatRuleDeletion.object_path,
+                                     body={IsoflatRuleDeletion.resource: body})
+        rule_ids = result[IsoflatRuleDeletion.resource]['rule_ids']
+        print(_('Deleted %(resource)s(s): %(ids)s') %
+              {'resource': self.resource, 'ids': ', '.join(rule_ids)},
+              file=self.app.stdout)
+
 
 class ShowIsoflatRule(extension.ClientExtensionShow, IsoflatRule):
     """Show an Isoflat rule."""
@@ -1,19 +1,140 @@
+import os
+import sys
+
+from neutron.agent.common import utils
+from neutron.agent.linux import bridge_lib
+from neutron.agent.linux import ip_lib
+from oslo_config import cfg
+from oslo_log import log as logging
+
 from neutron_isoflat.services.isoflat.agents.extensions import isoflat
 
+LOG = logging.getLogger(__name__)
+
 
 class IsoflatLinuxBridgeDriver(isoflat.IsoflatAgentDriverBase):
+    """
+    Isoflat agent driver for the Linux bridge agent.
 
-    def save_bridge_mappings(self):
-        pass
+    Every physical network gets a Linux mirror bridge which the agent's
+    bridge mappings point to, plugged into the physical bridge by a veth
+    pair. The links of all the physical networks are set up by a couple of
+    'ip -batch' runs instead of one ip command per operation.
+    """
 
-    def setup_isoflat_bridges(self):
-        pass
+    _bridge_mappings_changed = False
+
+    def __init__(self, agent_extension):
+        super(IsoflatLinuxBridgeDriver, self).__init__(agent_extension)
+        self.lb_bridge_mappings = self._parse_bridge_mappings(cfg.CONF.LINUX_BRIDGE.bridge_mappings)
+        self.lb_interface_mappings = self._parse_bridge_mappings(
+            cfg.CONF.LINUX_BRIDGE.physical_interface_mappings)
+        self.iso_bridge_mappings = self._parse_bridge_mappings(cfg.CONF.ISOFLAT.bridge_mappings, False)
 
     def initialize(self):
-        pass
+        # reboot the agent if bridge mappings changes
+        if self._bridge_mappings_changed:
+            os.execl(sys.executable, sys.executable, *sys.argv)
+        # refresh firewall rules on agent restart
+        self.agent_extension.sync_rules(list(self.iso_bridge_mappings))
 
     def consume_api(self, agent_api):
         pass
 
+    @staticmethod
+    def _ip_batch(commands):
+        """Run ip commands in a single ip process."""
+        if commands:
+            utils.execute(['ip', '-batch', '-'], process_input='\n'.join(commands) + '\n',
+                          run_as_root=True)
+
+    def _allocate_bridge_name(self, existing_devices):
+        """
+        Create a random bridge name and make sure no device with the same name exists.
+
+        :param existing_devices: Names of the devices on the host
+        """
+        name = None
+        while name is None:
+            name = self._random_name()
+            if name in self.iso_bridge_mappings.values() or name in self.lb_bridge_mappings.values():
+                name = None
+            elif name in existing_devices:
+                name = None
+        return name
+
+    def _setup_isoflat_bridges(self, bridges, existing_devices):
+        """
+        Set up the mirror bridges and their veth pairs.
+
+        :param bridges: A list of (physical bridge name, mirror bridge name)
+        :param existing_devices: Names of the devices on the host
+        """
+        stale_veths = [self._get_iso_if_name(iso_br_name) for _phy_br_name, iso_br_name in bridges
+                       if self._get_iso_if_name(iso_br_name) in existing_devices]
+        if stale_veths:
+            # deleting one end of a veth pair deletes the other one as well
+            self._ip_batch(['link delete dev %s' % name for name in stale_veths])
+            # Give udev a chance to process its rules here, to avoid
+            # race conditions between commands launched by udev rules
+            # and the subsequent creation of the veth pairs
+            utils.execute(['udevadm', 'settle', '--timeout=10'])
+
+        commands = []
+        for phy_br_name, iso_br_name in bridges:
+            phy_if_name = self._get_phy_if_name(iso_br_name)
+            iso_if_name = self._get_iso_if_name(iso_br_name)
+            if iso_br_name not in existing_devices:
+                commands.append('link add name %s type bridge' % iso_br_name)
+            commands += [
+                'link add name %s type veth peer name %s' % (phy_if_name, iso_if_name),
+                'link set dev %s master %s' % (iso_if_name, iso_br_name),
+                'link set dev %s master %s' % (phy_if_name, phy_br_name),
+                'link set dev %s up' % iso_br_name,
+                # enable veth to pass traffic
+                'link set dev %s up' % phy_if_name,
+                'link set dev %s up' % iso_if_name,
+            ]
+        self._ip_batch(commands)
+        for phy_br_name, iso_br_name in bridges:
+            LOG.info("Added Linux bridge Isoflat bridge %s and veth port pair "
+                     "(%s, %s)" % (iso_br_name, self._get_phy_if_name(iso_br_name),
+                                   self._get_iso_if_name(iso_br_name)))
+
+    def setup_isoflat_bridges(self):
+        # a single listing of the devices, not one ip command per device
+        existing_devices = set(device.name for device in ip_lib.IPWrapper().get_devices())
+        bridges = []
+        for physical_network in sorted(self.iso_bridge_mappings):
+            phy_br_name = self.iso_bridge_mappings[physical_network]
+            if physical_network in self.lb_interface_mappings:
+                LOG.error("Physical network %(physical_network)s has a physical interface "
+                          "mapping in the linux bridge agent, which cannot be combined with "
+                          "Isoflat. Isoflat agent terminated!",
+                          {'physical_network': physical_network})
+                sys.exit(1)
+            if physical_network not in self.lb_bridge_mappings:
+                self._bridge_mappings_changed = True
+                if not bridge_lib.BridgeDevice(phy_br_name).exists():
+                    LOG.error("Linux bridge %(bridge)s for physical network "
+                              "%(physical_network)s does not exist. Isoflat agent "
+                              "terminated!",
+                              {'physical_network': physical_network,
+                               'bridge': phy_br_name})
+                    sys.exit(1)
+                iso_br_name = self._allocate_bridge_name(existing_devices)
+                self.lb_bridge_mappings[physical_network] = iso_br_name
+            else:
+                iso_br_name = self.lb_bridge_mappings[physical_network]
+            bridges.append((phy_br_name, iso_br_name))
+        self._setup_isoflat_bridges(bridges, existing_devices)
+
+    def save_bridge_mappings(self):
+        if not self._bridge_mappings_changed:
+            return
+        self._write_bridge_mappings('linux_bridge', self.lb_bridge_mappings)
+
     def update_rules(self, context, physical_network, isoflat_rules):
-        pass
+        mirror_bridge = self.lb_bridge_mappings[physical_network]
+        device = self._get_phy_if_name(mirror_bridge)
+        self.firewall.update_firewall_rules(device, physical_network, isoflat_rules)
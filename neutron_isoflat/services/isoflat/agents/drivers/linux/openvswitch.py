@@ -1,6 +1,5 @@
 import os
 import sys
-from ConfigParser import SafeConfigParser
 
 from neutron.agent.common import ovs_lib
 from neutron.agent.common import utils
@@ -28,9 +27,7 @@ class IsoflatOvsDriver(isoflat.IsoflatAgentDriverBase):
         if self._bridge_mappings_changed:
             os.execl(sys.executable, sys.executable, *sys.argv)
         # refresh firewall rules on agent restart
-        for physical_network in self.iso_bridge_mappings:
-            rules = self.agent_extension.get_rules_for_network(physical_network)
-            self.update_rules(None, physical_network, rules)
+        self.agent_extension.sync_rules(list(self.iso_bridge_mappings))
 
     def consume_api(self, agent_api):
         pass
@@ -103,20 +100,7 @@ class IsoflatOvsDriver(isoflat.IsoflatAgentDriverBase):
     def save_bridge_mappings(self):
         if not self._bridge_mappings_changed:
             return
-        for i, arg in enumerate(sys.argv):
-            if arg == '--config-file':
-                config_file = sys.argv[i + 1]
-                parser = SafeConfigParser()
-                parser.read(config_file)
-                if not parser.has_section('isoflat'):
-                    continue
-                bridge_mapping_str = ','.join([network + ':' + bridge
-                                               for network, bridge in self.ovs_bridge_mappings.items()])
-                if not parser.has_section('ovs'):
-                    parser.add_section('ovs')
-                parser.set('ovs', 'bridge_mappings', bridge_mapping_str)
-                with open(config_file, 'wb') as f:
-                    parser.write(f)
+        self._write_bridge_mappings('ovs', self.ovs_bridge_mappings)
 
     def update_rules(self, context, physical_network, isoflat_rules):
         mirror_bridge = self.ovs_bridge_mappings[physical_network]
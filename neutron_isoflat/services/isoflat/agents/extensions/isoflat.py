@@ -1,9 +1,17 @@
 import abc
+import collections
+import hashlib
+import json
+import os
 import random
 import string
+import sys
+import threading
+import time
 
 import oslo_messaging as messaging
 import six
+from six.moves import configparser
 from neutron import manager
 from neutron.common import rpc as n_rpc
 from neutron_lib import context as qcontext
@@ -11,9 +19,12 @@ from neutron_lib.agent import l2_extension
 from neutron_lib.utils import helpers
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import fileutils
 
 from neutron_isoflat._i18n import _
 from neutron_isoflat.common import constants
+from neutron_isoflat.common import topics
+from neutron_isoflat.common import utils
 from neutron_isoflat.services.isoflat.agents.firewall.linux import firewall
 
 LOG = logging.getLogger(__name__)
@@ -22,7 +33,8 @@ OPTS = [
     cfg.StrOpt(
         'firewall_driver',
         default='ebtables',
-        help=_('Class name of the firewall driver Isoflat uses to filter flat network traffic.')
+        help=_('Class name of the firewall driver Isoflat uses to filter flat network traffic, '
+               'e.g. ebtables or nftables.')
     ),
     cfg.ListOpt('bridge_mappings',
                 default=constants.DEFAULT_BRIDGE_MAPPINGS,
@@ -39,6 +51,34 @@ OPTS = [
                        "mapping, make sure to disconnect it from the "
                        "integration bridge as it won't be managed by the "
                        "agent anymore.")),
+    cfg.IntOpt('ebtables_resync_interval',
+               default=60,
+               help=_("Seconds the ebtables state the agent applied last is "
+                      "trusted for. Meanwhile rule updates are diffed against "
+                      "it, and updates without changes run no ebtables-save. "
+                      "An update with changes always runs one ebtables-save "
+                      "under the ebtables lock before ebtables-restore "
+                      "replaces the tables, so the rules other programs added "
+                      "are kept. Set to 0 to diff every update against that "
+                      "save only.")),
+    cfg.IntOpt('ebtables_convergence_check_every',
+               default=1,
+               min=1,
+               help=_("With [AGENT] debug_iptables_rules set, check every "
+                      "Nth ebtables update against ebtables-save, and log "
+                      "what the checks cost and the divergences they "
+                      "found.")),
+    cfg.StrOpt('rules_state_file',
+               default='$state_path/isoflat/rules.json',
+               help=_("File the agent keeps the isoflat rules it applied last in. "
+                      "On restart they are applied again right away, before the "
+                      "agent hears back from the server.")),
+    cfg.IntOpt('rules_check_interval',
+               default=300,
+               help=_("Seconds between checks of the isoflat rules the agent "
+                      "applied against the server's, by a digest of the rules "
+                      "of each physical network. The rules are only fetched "
+                      "again when the digests differ. Set to 0 to disable.")),
 ]
 cfg.CONF.register_opts(OPTS, constants.ISOFLAT)
 
@@ -85,6 +125,29 @@ class IsoflatAgentDriverBase(object):
         except ValueError as e:
             raise ValueError(_("Parsing bridge_mappings failed: %s.") % e)
 
+    @staticmethod
+    def _write_bridge_mappings(section, bridge_mappings):
+        """
+        Write bridge mappings to the given section of the agent's Isoflat config file.
+
+        :param section: The section of the L2 agent, e.g. ovs or linux_bridge
+        :param bridge_mappings: A dict of physical network -> bridge name
+        """
+        for i, arg in enumerate(sys.argv):
+            if arg == '--config-file':
+                config_file = sys.argv[i + 1]
+                parser = configparser.SafeConfigParser()
+                parser.read(config_file)
+                if not parser.has_section('isoflat'):
+                    continue
+                bridge_mapping_str = ','.join([network + ':' + bridge
+                                               for network, bridge in bridge_mappings.items()])
+                if not parser.has_section(section):
+                    parser.add_section(section)
+                parser.set(section, 'bridge_mappings', bridge_mapping_str)
+                with open(config_file, 'w') as f:
+                    parser.write(f)
+
     @abc.abstractmethod
     def initialize(self):
         """Agent driver initialization."""
@@ -114,15 +177,56 @@ class IsoflatAgentDriverBase(object):
         """Update firewall rules for a physical network."""
 
 
+SYNC_RULES = object()
+# seconds to wait before syncing the rules of a network again after a failed
+# update, doubled on every failure up to the maximum
+SYNC_RETRY_MIN_DELAY = 1
+SYNC_RETRY_MAX_DELAY = 60
+
+
+def _rulesets_checksum(rulesets):
+    return hashlib.sha256(json.dumps(rulesets, sort_keys=True).encode('utf-8')).hexdigest()
+
+
 class IsoflatAgentExtension(l2_extension.L2AgentExtension):
+    """
+    RPC API version history:
+        1.0 - Initial version.
+        1.1 - Added update_rules_delta, carrying the rules added and removed
+              by a generation of the rules of a physical network.
+        1.2 - update_rules_delta takes the base_generation it applies to.
+    """
+
+    target = messaging.Target(version='1.2')
+
     agent_api = None
     driver = None
     context = None
+    physical_networks = ()
+
+    def __init__(self):
+        super(IsoflatAgentExtension, self).__init__()
+        # physical_network -> generation of the rules in self._rules
+        self._generations = {}
+        # physical_network -> {rule id: rule}
+        self._rules = {}
+        # physical_network -> ruleset to apply, or SYNC_RULES to fetch it;
+        # only the latest ruleset of a physical network is kept
+        self._pending_updates = collections.OrderedDict()
+        # guards the three above
+        self._updates_pending = threading.Condition()
+        # physical_network -> ruleset in the firewall, as saved in the
+        # rules state file; only used by the update worker
+        self._applied_rulesets = {}
 
     def _setup_rpc(self):
         endpoints = [self]
         conn = n_rpc.create_connection()
+        # servers cast rule updates to the topic of the physical network
+        # only, the common topic is kept for servers which cast to everyone
         conn.create_consumer(constants.TOPIC_ISOFLAT_AGENT, endpoints, fanout=False)
+        for physical_network in self.physical_networks:
+            conn.create_consumer(topics.get_agent_topic(physical_network), endpoints, fanout=True)
         conn.consume_in_threads()
         target = messaging.Target(topic=constants.TOPIC_ISOFLAT_PLUGIN, version='1.0')
         self.client = n_rpc.get_client(target)
@@ -133,6 +237,8 @@ class IsoflatAgentExtension(l2_extension.L2AgentExtension):
     def initialize(self, connection, driver_type):
         LOG.debug("Isoflat agent initialize called")
         self.context = qcontext.get_admin_context_without_session()
+        self.physical_networks = frozenset(IsoflatAgentDriverBase._parse_bridge_mappings(
+            cfg.CONF.ISOFLAT.bridge_mappings, False))
         self._setup_rpc()
 
         self.driver = manager.NeutronManager.load_class_for_provider(
@@ -140,6 +246,10 @@ class IsoflatAgentExtension(l2_extension.L2AgentExtension):
         self.driver.consume_api(self.agent_api)
         self.driver.setup_isoflat_bridges()
         self.driver.save_bridge_mappings()
+        self._restore_rules()
+        worker = threading.Thread(target=self._process_updates, name='isoflat-rule-updates')
+        worker.daemon = True
+        worker.start()
         self.driver.initialize()
 
     def handle_port(self, context, data):
@@ -148,11 +258,288 @@ class IsoflatAgentExtension(l2_extension.L2AgentExtension):
     def delete_port(self, context, data):
         pass
 
-    def update_rules(self, context, physical_network, isoflat_rules):
+    def _is_served(self, physical_network):
+        if physical_network in self.physical_networks:
+            return True
+        LOG.debug("Physical network %s has no bridge mapping on this agent, "
+                  "ignoring its isoflat rules", physical_network)
+        return False
+
+    def _queue_update(self, physical_network, ruleset):
+        # a newer update replaces the pending one, only the latest matters,
+        # except for a pending fetch: it was queued for a generation the
+        # ruleset may still lag behind, and fetches the latest rules anyway
+        if self._pending_updates.get(physical_network) is SYNC_RULES:
+            self._updates_pending.notify()
+            return
+        self._pending_updates.pop(physical_network, None)
+        self._pending_updates[physical_network] = ruleset
+        self._updates_pending.notify()
+
+    def _store_rules(self, physical_network, isoflat_rules, generation):
+        if generation is None:
+            # without a generation the next delta cannot be trusted
+            self._generations.pop(physical_network, None)
+            self._rules.pop(physical_network, None)
+        else:
+            self._generations[physical_network] = generation
+            self._rules[physical_network] = dict((rule['id'], rule) for rule in isoflat_rules)
+
+    def _set_rules(self, physical_network, isoflat_rules, generation):
+        self._store_rules(physical_network, isoflat_rules, generation)
+        self._queue_update(physical_network, {'generation': generation, 'rules': isoflat_rules})
+
+    def _load_rules_state(self):
+        """
+        Read the rulesets the agent applied before it restarted.
+
+        :returns: a dict of physical network -> ruleset, empty when there
+            is no state file or it cannot be trusted
+        """
+        path = cfg.CONF.ISOFLAT.rules_state_file
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            if state['checksum'] == _rulesets_checksum(state['rulesets']):
+                return state['rulesets']
+            LOG.warning("Checksum mismatch in isoflat rules state file %s, ignoring it", path)
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            LOG.warning("Failed to read isoflat rules state file %s, ignoring it", path,
+                        exc_info=True)
+        return {}
+
+    def _save_rules_state(self):
+        """Write the applied rulesets to the state file, atomically."""
+        path = cfg.CONF.ISOFLAT.rules_state_file
+        tmp_path = '%s.tmp' % path
+        state = {'checksum': _rulesets_checksum(self._applied_rulesets),
+                 'rulesets': self._applied_rulesets}
+        try:
+            fileutils.ensure_tree(os.path.dirname(path))
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            LOG.exception("Failed to write isoflat rules state file %s", path)
+
+    def _restore_rules(self):
+        """Apply the rulesets of the state file before the server is asked."""
+        rulesets = collections.OrderedDict(
+            (physical_network, ruleset)
+            for physical_network, ruleset in sorted(self._load_rules_state().items())
+            if physical_network in self.physical_networks)
+        if not rulesets:
+            return
+        LOG.info("Restoring isoflat rules of networks %s from the state file",
+                 ', '.join(rulesets))
+        with self._updates_pending:
+            for physical_network, ruleset in rulesets.items():
+                self._store_rules(physical_network, ruleset['rules'], ruleset['generation'])
+        try:
+            self._apply_updates(rulesets)
+        except Exception:
+            LOG.exception("Failed to restore isoflat rules of networks %s", ', '.join(rulesets))
+            with self._updates_pending:
+                for physical_network in rulesets:
+                    self._generations.pop(physical_network, None)
+                    self._rules.pop(physical_network, None)
+
+    def _apply_updates(self, updates):
+        physical_networks = [physical_network for physical_network, ruleset in updates.items()
+                             if ruleset is SYNC_RULES]
+        if physical_networks:
+            # a single call for all the physical networks to fetch
+            rulesets = self.get_rulesets_for_networks(physical_networks)
+            with self._updates_pending:
+                for physical_network in physical_networks:
+                    ruleset = rulesets[physical_network]
+                    current = self._generations.get(physical_network)
+                    if current is not None and current > ruleset['generation']:
+                        # a newer update came in meanwhile and is queued
+                        del updates[physical_network]
+                        continue
+                    self._store_rules(physical_network, ruleset['rules'], ruleset['generation'])
+                    applied = self._applied_rulesets.get(physical_network)
+                    if applied is not None and applied['generation'] == ruleset['generation']:
+                        # e.g. restored from the state file and unchanged since
+                        LOG.debug("Isoflat rules of network %s are up to date", physical_network)
+                        del updates[physical_network]
+                    else:
+                        updates[physical_network] = ruleset
+        for physical_network, ruleset in list(updates.items()):
+            applied = self._applied_rulesets.get(physical_network)
+            if (applied is not None and ruleset['generation'] is not None and
+                    ruleset['generation'] <= applied['generation']):
+                # e.g. queued while a fetch applied a newer generation
+                LOG.debug("Isoflat rules of network %s are at generation %s already, "
+                          "dropping generation %s", physical_network, applied['generation'],
+                          ruleset['generation'])
+                del updates[physical_network]
+        if not updates:
+            return
+        # a single firewall apply for all the physical networks
+        with self.driver.firewall.defer_apply():
+            for physical_network, ruleset in updates.items():
+                LOG.debug("Applying isoflat rules of network %s", physical_network)
+                self.driver.update_rules(self.context, physical_network, ruleset['rules'])
+        for physical_network, ruleset in updates.items():
+            if ruleset['generation'] is None:
+                self._applied_rulesets.pop(physical_network, None)
+            else:
+                self._applied_rulesets[physical_network] = ruleset
+        self._save_rules_state()
+
+    def _check_rules(self):
+        """
+        Check the applied rules against the server's and fetch those which differ.
+
+        Only the digests of the rules are sent, the server answers with the
+        rulesets of the physical networks whose digest differs.
+        """
+        digests = {}
+        for physical_network in self.physical_networks:
+            applied = self._applied_rulesets.get(physical_network)
+            digests[physical_network] = (None if applied is None
+                                         else utils.get_rules_digest(applied['rules']))
+        rulesets = self.check_rulesets_for_networks(digests)
+        with self._updates_pending:
+            for physical_network, ruleset in rulesets.items():
+                current = self._generations.get(physical_network)
+                if current is not None and current > ruleset['generation']:
+                    # a newer update came in meanwhile
+                    continue
+                LOG.warning("Isoflat rules of network %s differ from the server's, "
+                            "applying the rules of generation %s",
+                            physical_network, ruleset['generation'])
+                # the applied rules are wrong, whatever their generation
+                self._applied_rulesets.pop(physical_network, None)
+                self._set_rules(physical_network, ruleset['rules'], ruleset['generation'])
+
+    def _process_updates(self):
+        """
+        Apply the queued rule updates.
+
+        Runs in a thread of its own, so the RPC consumers are not held up by
+        the firewall. All the updates queued meanwhile are applied together,
+        and a burst of updates of a physical network is applied only once.
+        Every rules_check_interval seconds the applied rules are checked
+        against the server's. The physical networks whose update failed are
+        synced again after a delay doubling on every failure.
+        """
+        interval = cfg.CONF.ISOFLAT.rules_check_interval
+        next_check = time.time() + interval if interval > 0 else None
+        retry_networks = set()
+        retry_delay = 0
+        retry_at = None
+        while True:
+            with self._updates_pending:
+                while not self._pending_updates:
+                    deadlines = [deadline for deadline in (next_check, retry_at) if deadline is not None]
+                    if not deadlines:
+                        self._updates_pending.wait()
+                        continue
+                    timeout = min(deadlines) - time.time()
+                    if timeout <= 0:
+                        break
+                    self._updates_pending.wait(timeout)
+                if retry_at is not None and time.time() >= retry_at:
+                    retry_at = None
+                    for physical_network in retry_networks:
+                        if physical_network not in self._pending_updates:
+                            self._queue_update(physical_network, SYNC_RULES)
+                updates = self._pending_updates
+                self._pending_updates = collections.OrderedDict()
+            if next_check is not None and time.time() >= next_check:
+                next_check = time.time() + interval
+                try:
+                    self._check_rules()
+                except Exception:
+                    LOG.exception("Failed to check isoflat rules against the server")
+            if not updates:
+                continue
+            try:
+                self._apply_updates(updates)
+            except Exception:
+                LOG.exception("Failed to update isoflat rules of networks %s", ', '.join(updates))
+                with self._updates_pending:
+                    # fetch all the rules again on the next change
+                    for physical_network in updates:
+                        self._generations.pop(physical_network, None)
+                        self._rules.pop(physical_network, None)
+                for physical_network in updates:
+                    self._applied_rulesets.pop(physical_network, None)
+                retry_networks.update(updates)
+                retry_delay = min(max(retry_delay * 2, SYNC_RETRY_MIN_DELAY), SYNC_RETRY_MAX_DELAY)
+                retry_at = time.time() + retry_delay
+                LOG.info("Syncing isoflat rules of networks %s again in %s seconds",
+                         ', '.join(sorted(retry_networks)), retry_delay)
+            else:
+                retry_networks.difference_update(updates)
+                if not retry_networks:
+                    retry_delay = 0
+                    retry_at = None
+
+    def sync_rules(self, physical_networks):
+        """Fetch all the rules of the physical networks and apply them."""
+        with self._updates_pending:
+            for physical_network in physical_networks:
+                self._queue_update(physical_network, SYNC_RULES)
+
+    def update_rules(self, context, physical_network, isoflat_rules, generation=None):
         LOG.debug("Received an RPC call for updating isoflat rules on network %s" % physical_network)
-        self.driver.update_rules(context, physical_network, isoflat_rules)
+        if not self._is_served(physical_network):
+            return
+        with self._updates_pending:
+            if generation is None and physical_network in self._generations:
+                # servers cast the full rules without generation for agents
+                # not upgraded yet, the deltas keep this agent up to date
+                LOG.debug("Ignoring isoflat rules of network %s without generation",
+                          physical_network)
+                return
+            self._set_rules(physical_network, isoflat_rules, generation)
+
+    def update_rules_delta(self, context, physical_network, generation, added_rules, removed_rule_ids,
+                           base_generation=None):
+        LOG.debug("Received an RPC call for updating isoflat rules on network %s "
+                  "to generation %s", physical_network, generation)
+        if not self._is_served(physical_network):
+            return
+        if base_generation is None:
+            base_generation = generation - 1
+        with self._updates_pending:
+            current = self._generations.get(physical_network)
+            if current is not None and generation <= current:
+                LOG.debug("Isoflat rules of network %s are at generation %s already, "
+                          "ignoring generation %s", physical_network, current, generation)
+                return
+            if current != base_generation:
+                LOG.info("Missed isoflat rule changes of network %(network)s between "
+                         "generation %(current)s and %(generation)s, fetching all rules",
+                         {'network': physical_network, 'current': current,
+                          'generation': generation})
+                self._queue_update(physical_network, SYNC_RULES)
+                return
+            rules = self._rules[physical_network]
+            for rule_id in removed_rule_ids:
+                rules.pop(rule_id, None)
+            for rule in added_rules:
+                rules[rule['id']] = rule
+            self._generations[physical_network] = generation
+            self._queue_update(physical_network, {'generation': generation,
+                                                  'rules': list(rules.values())})
+
+    def get_rulesets_for_networks(self, physical_networks):
+        LOG.debug("Get isoflat rules and their generation for physical networks %s via rpc",
+                  ', '.join(physical_networks))
+        cctxt = self.client.prepare(version='1.3')
+        return cctxt.call(self.context, 'get_rulesets_for_networks',
+                          physical_networks=list(physical_networks))
 
-    def get_rules_for_network(self, physical_network):
-        LOG.debug("Get isoflat rules for physical network %s via rpc", physical_network)
-        cctxt = self.client.prepare()
-        return cctxt.call(self.context, 'get_rules_for_network', physical_network=physical_network)
+    def check_rulesets_for_networks(self, digests):
+        LOG.debug("Check isoflat rules of physical networks %s via rpc", ', '.join(digests))
+        cctxt = self.client.prepare(version='1.4')
+        return cctxt.call(self.context, 'check_rulesets_for_networks', digests=digests)
@@ -6,6 +6,7 @@ from oslo_log import log as logging
 
 from neutron_isoflat.services.isoflat.agents.firewall.linux import ebtables_manager
 from neutron_isoflat.services.isoflat.agents.firewall.linux import firewall
+from neutron_isoflat.services.isoflat.agents.firewall.linux import rule_compiler
 
 LOG = logging.getLogger(__name__)
 
@@ -13,12 +14,16 @@ BINARY_NAME = 'neutron-isoflat'
 ISOFLAT_CHAIN = 'iso-chain'
 CHAIN_NAME_PREFIX = {constants.INGRESS_DIRECTION: 'i-',
                      constants.EGRESS_DIRECTION: 'o-'}
+FALLBACK_JUMP_RULE = '-j $fallback'
 
 
 class EbtablesFirewall(firewall.FirewallDriver):
 
     def __init__(self):
         self.ebtables = ebtables_manager.EbtablesManager(state_less=True, _binary_name=BINARY_NAME)
+        # (physical_network, direction) -> (device, ebtables rules) of the
+        # chains currently in the table
+        self._installed_chains = {}
         self._add_isoflat_chain_v4v6()
         self._add_fallback_chain_v4v6()
 
@@ -33,33 +38,79 @@ class EbtablesFirewall(firewall.FirewallDriver):
     def _remove_chain_by_name_v4v6(self, chain_name):
         self.ebtables.tables['filter'].remove_chain(chain_name)
 
-    def _add_chain(self, chain_name, device, direction):
-        self._add_chain_by_name_v4v6(chain_name)
-
+    @staticmethod
+    def _jump_rules(chain_name, device, direction):
         if direction == constants.EGRESS_DIRECTION:
-            jump_rule = ['-%s %s -j $%s' % ('i', device, chain_name)]
-            self._add_rules_to_chain_v4v6('INPUT', jump_rule, comment=ic.INPUT_TO_SG)
-            self._add_rules_to_chain_v4v6('FORWARD', jump_rule, comment=ic.SG_TO_VM_SG)
+            jump_rule = '-%s %s -j $%s' % ('i', device, chain_name)
+            return [('INPUT', jump_rule, ic.INPUT_TO_SG),
+                    ('FORWARD', jump_rule, ic.SG_TO_VM_SG)]
+        jump_rule = '-%s %s -j $%s' % ('o', device, chain_name)
+        return [('OUTPUT', jump_rule, ic.INPUT_TO_SG),
+                ('FORWARD', jump_rule, ic.SG_TO_VM_SG)]
 
-        if direction == constants.INGRESS_DIRECTION:
-            jump_rule = ['-%s %s -j $%s' % ('o', device, chain_name)]
-            self._add_rules_to_chain_v4v6('OUTPUT', jump_rule, comment=ic.INPUT_TO_SG)
-            self._add_rules_to_chain_v4v6('FORWARD', jump_rule, comment=ic.SG_TO_VM_SG)
+    def _add_jump_rules(self, chain_name, device, direction):
+        for chain, rule, comment in self._jump_rules(chain_name, device, direction):
+            self.ebtables.tables['filter'].add_rule(chain, rule, comment=comment)
+
+    def _remove_jump_rules(self, chain_name, device, direction):
+        for chain, rule, comment in self._jump_rules(chain_name, device, direction):
+            self.ebtables.tables['filter'].remove_rule(chain, rule, comment=comment)
+
+    def _add_chain(self, chain_name, device, direction):
+        self._add_chain_by_name_v4v6(chain_name)
+        self._add_jump_rules(chain_name, device, direction)
 
-    def _add_rules_to_chain(self, chain_name, rules):
+    def _compile_chain_rules(self, rules, direction):
+        rules = [rule for rule in rules if rule['direction'] == direction]
+        rules, removed = rule_compiler.compile_rules(rules)
+        LOG.debug("Compiled %d %s rules, %d redundant rules removed",
+                  len(rules), direction, removed)
         # split groups by ip version
-        rules = self._split_rules_by_remote_ips(rules)
         ipv4_rules, ipv6_rules = self._split_rules_by_ethertype(rules)
         ebtables_rules = self._convert_isoflat_to_ebtables_rules(ipv4_rules, 4)
         ebtables_rules += self._convert_isoflat_to_ebtables_rules(ipv6_rules, 6)
-        # finally add the rules to the port chain for a given direction
-        self._add_rules_to_chain_v4v6(chain_name, ebtables_rules)
+        # whatever is not dropped is accepted by the fallback chain
+        return ebtables_rules + [FALLBACK_JUMP_RULE]
 
     def _setup_chain(self, device, physical_network, rules, direction):
         chain_name = self._network_chain_name(physical_network, direction)
         self._add_chain(chain_name, device, direction)
-        new_rules = [rule for rule in rules if rule['direction'] == direction]
-        self._add_rules_to_chain(chain_name, new_rules)
+        self._add_rules_to_chain_v4v6(chain_name, rules)
+
+    def _update_chain(self, device, physical_network, rules, direction):
+        """Bring a network chain to the given rules, touching only what changed.
+
+        Rules that are gone are removed and new ones are added before the
+        fallback jump, which has to stay last. The jump rules pointing at
+        the chain are only replaced when the device changed.
+        """
+        key = (physical_network, direction)
+        chain_name = self._network_chain_name(physical_network, direction)
+        if key not in self._installed_chains:
+            self._setup_chain(device, physical_network, rules, direction)
+            self._installed_chains[key] = (device, rules)
+            return
+
+        installed_device, installed_rules = self._installed_chains[key]
+        if installed_device != device:
+            self._remove_jump_rules(chain_name, installed_device, direction)
+            self._add_jump_rules(chain_name, device, direction)
+
+        new_rules = set(rules)
+        kept_rules = []
+        for rule in installed_rules:
+            if rule in new_rules:
+                kept_rules.append(rule)
+            else:
+                self.ebtables.tables['filter'].remove_rule(chain_name, rule)
+        kept = set(kept_rules)
+        added_rules = [rule for rule in rules if rule not in kept]
+        if added_rules:
+            self.ebtables.tables['filter'].remove_rule(chain_name, FALLBACK_JUMP_RULE)
+            kept_rules.remove(FALLBACK_JUMP_RULE)
+            added_rules.append(FALLBACK_JUMP_RULE)
+            self._add_rules_to_chain_v4v6(chain_name, added_rules)
+        self._installed_chains[key] = (device, kept_rules + added_rules)
 
     def _remove_chain(self, physical_network, direction):
         chain_name = self._network_chain_name(physical_network, direction)
@@ -157,7 +208,6 @@ class EbtablesFirewall(firewall.FirewallDriver):
                     continue
                 seen_rules.add(rule_command)
                 ebtables_rules.append(rule_command)
-        ebtables_rules += ['-j $fallback']
         return ebtables_rules
 
     @staticmethod
@@ -173,22 +223,14 @@ class EbtablesFirewall(firewall.FirewallDriver):
                 ipv6_sg_rules.append(rule)
         return ipv4_sg_rules, ipv6_sg_rules
 
-    @staticmethod
-    def _split_rules_by_remote_ips(isoflat_rules):
-        rules = []
-        for rule in isoflat_rules:
-            for remote_ip in rule['remote_ips']:
-                new_rule = dict(rule)
-                new_rule['remote_ip'] = remote_ip
-                rules.append(new_rule)
-        return rules
-
     def init_firewall(self):
         pass
 
+    def defer_apply(self):
+        return self.ebtables.defer_apply()
+
     def update_firewall_rules(self, device, physical_network, isoflat_rules):
-        self._remove_chain(physical_network, constants.INGRESS_DIRECTION)
-        self._remove_chain(physical_network, constants.EGRESS_DIRECTION)
-        self._setup_chain(device, physical_network, isoflat_rules, constants.INGRESS_DIRECTION)
-        self._setup_chain(device, physical_network, isoflat_rules, constants.EGRESS_DIRECTION)
+        for direction in (constants.INGRESS_DIRECTION, constants.EGRESS_DIRECTION):
+            rules = self._compile_chain_rules(isoflat_rules, direction)
+            self._update_chain(device, physical_network, rules, direction)
         self.ebtables.apply()
@@ -1,6 +1,8 @@
+import bisect
 import collections
 import contextlib
-import difflib
+import operator
+import os
 import re
 
 from neutron.agent.linux import ip_lib
@@ -14,6 +16,7 @@ from oslo_concurrency import lockutils
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import excutils
+from oslo_utils import timeutils
 
 from neutron_isoflat._i18n import _
 
@@ -29,6 +32,10 @@ XLOCK_WAIT_INTERVAL = 200000
 # a failure during ebtables-restore
 EBTABLES_ERROR_LINES_OF_CONTEXT = 5
 
+# Directories searched, in addition to $PATH, for the ebtables-restore binary.
+# rootwrap runs it from its exec_dirs, which usually include the sbin ones.
+SBIN_DIRS = ('/sbin', '/usr/sbin', '/usr/local/sbin')
+
 STANDARD_CHAINS = {
     'filter': ['FORWARD', 'INPUT', 'OUTPUT'],
     'nat': ['PREROUTING', 'OUTPUT', 'POSTROUTING'],
@@ -47,49 +54,130 @@ class EbtablesRule(object):
 
     You shouldn't need to use this class directly, it's only used by
     EbtablesManager.
+
+    Rules are immutable. The rendered '-A chain rule' line is built once
+    and the rule is read back from its tail, so str() costs nothing and the
+    rule string is not kept next to the line.
     """
 
+    __slots__ = ('_chain', '_wrap', '_top', '_wrap_name', '_tag', '_comment',
+                 '_line', '_rule_start')
+
     def __init__(self, chain, rule, wrap=True, top=False,
                  _binary_name=binary_name, tag=None, comment=None):
-        self.chain = get_chain_name(chain, wrap)
-        self.rule = rule
-        self.wrap = wrap
-        self.top = top
-        self.wrap_name = _binary_name[:16]
-        self.tag = tag
-        self.comment = comment
+        self._chain = get_chain_name(chain, wrap)
+        self._wrap = wrap
+        self._top = top
+        self._wrap_name = _binary_name[:16]
+        self._tag = tag
+        self._comment = comment
+        if wrap:
+            chain = '%s-%s' % (self._wrap_name, self._chain)
+        else:
+            chain = self._chain
+        line = '-A %s %s' % (chain, rule)
+        # If self.rule is '' the above will cause a trailing space, which
+        # could cause us to not match on save/restore, so strip it now.
+        # self._line = comment_rule(line.strip(), self.comment)
+        self._line = line.strip()
+        self._rule_start = len('-A %s ' % chain)
+
+    chain = property(operator.attrgetter('_chain'))
+    wrap = property(operator.attrgetter('_wrap'))
+    top = property(operator.attrgetter('_top'))
+    wrap_name = property(operator.attrgetter('_wrap_name'))
+    tag = property(operator.attrgetter('_tag'))
+    comment = property(operator.attrgetter('_comment'))
+
+    @property
+    def rule(self):
+        return self._line[self._rule_start:]
 
     def __eq__(self, other):
-        return ((self.chain == other.chain) and
-                (self.rule == other.rule) and
-                (self.top == other.top) and
-                (self.wrap == other.wrap))
+        # the line holds the chain and the rule
+        return ((self._line == other._line) and
+                (self._chain == other._chain) and
+                (self._top == other._top) and
+                (self._wrap == other._wrap))
 
     def __ne__(self, other):
         return not self == other
 
+    def __hash__(self):
+        # strings cache their hash, so this does not rehash the line
+        return hash(self._line)
+
     def __str__(self):
-        if self.wrap:
-            chain = '%s-%s' % (self.wrap_name, self.chain)
-        else:
-            chain = self.chain
-        rule = '-A %s %s' % (chain, self.rule)
-        # If self.rule is '' the above will cause a trailing space, which
-        # could cause us to not match on save/restore, so strip it now.
-        # return comment_rule(rule.strip(), self.comment)
-        return rule.strip()
+        return self._line
 
 
 class EbtablesTable(object):
-    """An ebtables table."""
+    """An ebtables table.
+
+    Rules are indexed by chain, by identity, by tag and by jump target, so
+    adding and removing them costs in proportion to the rules involved
+    rather than to the size of the table. The rules property still lists
+    them in insertion order.
+    """
 
     def __init__(self, _binary_name=binary_name):
-        self.rules = []
         self.remove_rules = []
         self.chains = set()
         self.unwrapped_chains = set()
         self.remove_chains = set()
         self.wrap_name = _binary_name[:16]
+        # every rule keyed by its insertion sequence number, in order
+        self._rules = collections.OrderedDict()
+        self._next_seq = 0
+        # chain name -> OrderedDict of sequence number -> rule
+        self._chain_index = {}
+        # rule -> sequence numbers of the identical rules, oldest first
+        self._rule_index = {}
+        # tag -> sequence numbers
+        self._tag_index = {}
+        # name of the chain jumped to -> sequence numbers
+        self._jump_index = {}
+
+    @property
+    def rules(self):
+        return list(self._rules.values())
+
+    def _insert(self, rule):
+        seq = self._next_seq
+        self._next_seq += 1
+        self._rules[seq] = rule
+        self._chain_index.setdefault(
+            rule.chain, collections.OrderedDict())[seq] = rule
+        self._rule_index.setdefault(rule, []).append(seq)
+        if rule.tag:
+            self._tag_index.setdefault(rule.tag, set()).add(seq)
+        target = _get_jump_target(rule.rule)
+        if target:
+            self._jump_index.setdefault(target, set()).add(seq)
+
+    def _discard(self, seq):
+        rule = self._rules.pop(seq)
+        chain_rules = self._chain_index[rule.chain]
+        del chain_rules[seq]
+        if not chain_rules:
+            del self._chain_index[rule.chain]
+        seqs = self._rule_index[rule]
+        seqs.remove(seq)
+        if not seqs:
+            del self._rule_index[rule]
+        if rule.tag:
+            self._discard_seq(self._tag_index, rule.tag, seq)
+        target = _get_jump_target(rule.rule)
+        if target:
+            self._discard_seq(self._jump_index, target, seq)
+        return rule
+
+    @staticmethod
+    def _discard_seq(index, key, seq):
+        seqs = index[key]
+        seqs.discard(seq)
+        if not seqs:
+            del index[key]
 
     def add_chain(self, name, wrap=True):
         """Adds a named chain to the table.
@@ -134,23 +222,22 @@ class EbtablesTable(object):
 
         chain_set.remove(name)
 
+        if wrap:
+            target = '%s-%s' % (self.wrap_name, name)
+        else:
+            target = name
+
+        # Remove rules that have a matching chain name or a matching
+        # jump chain
+        seqs = set(self._chain_index.get(name, ()))
+        seqs.update(self._jump_index.get(target, ()))
+        removed = [self._discard(seq) for seq in sorted(seqs)]
+
         if not wrap:
             # non-wrapped chains and rules need to be dealt with specially,
             # so we keep a list of them to be iterated over in apply()
             self.remove_chains.add(name)
-
-            # Add rules to remove that have a matching chain name or
-            # a matching jump chain
-            jump_snippet = '-j %s' % name
-            self.remove_rules += [str(r) for r in self.rules
-                                  if r.chain == name or jump_snippet in r.rule]
-        else:
-            jump_snippet = '-j %s-%s' % (self.wrap_name, name)
-
-        # Remove rules from list that have a matching chain name or
-        # a matching jump chain
-        self.rules = [r for r in self.rules
-                      if r.chain != name and jump_snippet not in r.rule]
+            self.remove_rules += [str(r) for r in removed]
 
     def add_rule(self, chain, rule, wrap=True, top=False, tag=None,
                  comment=None):
@@ -172,8 +259,8 @@ class EbtablesTable(object):
             rule = ' '.join(
                 self._wrap_target_chain(e, wrap) for e in rule.split(' '))
 
-        self.rules.append(EbtablesRule(chain, rule, wrap, top, self.wrap_name,
-                                       tag, comment))
+        self._insert(EbtablesRule(chain, rule, wrap, top, self.wrap_name,
+                                  tag, comment))
 
     def _wrap_target_chain(self, s, wrap):
         if s.startswith('$'):
@@ -190,41 +277,50 @@ class EbtablesTable(object):
 
         """
         chain = get_chain_name(chain, wrap)
-        try:
-            if '$' in rule:
-                rule = ' '.join(
-                    self._wrap_target_chain(e, wrap) for e in rule.split(' '))
-
-            self.rules.remove(EbtablesRule(chain, rule, wrap, top,
-                                           self.wrap_name,
-                                           comment=comment))
-            if not wrap:
-                self.remove_rules.append(str(EbtablesRule(chain, rule, wrap,
-                                                          top, self.wrap_name,
-                                                          comment=comment)))
-        except ValueError:
+        if '$' in rule:
+            rule = ' '.join(
+                self._wrap_target_chain(e, wrap) for e in rule.split(' '))
+
+        ebtables_rule = EbtablesRule(chain, rule, wrap, top, self.wrap_name,
+                                     comment=comment)
+        seqs = self._rule_index.get(ebtables_rule)
+        if not seqs:
             LOG.warning('Tried to remove rule that was not there:'
                         ' %(chain)r %(rule)r %(wrap)r %(top)r',
                         {'chain': chain, 'rule': rule,
                          'top': top, 'wrap': wrap})
+            return
+
+        self._discard(seqs[0])
+        if not wrap:
+            self.remove_rules.append(str(ebtables_rule))
 
     def _get_chain_rules(self, chain, wrap):
         chain = get_chain_name(chain, wrap)
-        return [rule for rule in self.rules
-                if rule.chain == chain and rule.wrap == wrap]
+        return [rule for rule in self._chain_index.get(chain, {}).values()
+                if rule.wrap == wrap]
 
     def empty_chain(self, chain, wrap=True):
         """Remove all rules from a chain."""
-        chained_rules = self._get_chain_rules(chain, wrap)
-        for rule in chained_rules:
-            self.rules.remove(rule)
+        chain = get_chain_name(chain, wrap)
+        seqs = [seq for seq, rule in self._chain_index.get(chain, {}).items()
+                if rule.wrap == wrap]
+        for seq in seqs:
+            self._discard(seq)
 
     def clear_rules_by_tag(self, tag):
         if not tag:
             return
-        rules = [rule for rule in self.rules if rule.tag == tag]
-        for rule in rules:
-            self.rules.remove(rule)
+        for seq in sorted(self._tag_index.get(tag, ())):
+            self._discard(seq)
+
+
+def _get_jump_target(rule):
+    parts = rule.split(' ')
+    try:
+        return parts[parts.index('-j') + 1]
+    except (ValueError, IndexError):
+        return None
 
 
 class EbtablesManager(object):
@@ -236,6 +332,10 @@ class EbtablesManager(object):
     # run ebtables-restore without it.
     use_table_lock = False
 
+    # Whether ebtables-restore is installed. Probed once on the first apply,
+    # when it is missing the per-command path is used instead.
+    atomic_restore_available = None
+
     def __init__(self, _execute=None, state_less=False, namespace=None, _binary_name=binary_name):
         if _execute:
             self.execute = _execute
@@ -246,6 +346,19 @@ class EbtablesManager(object):
         self.ebtables_apply_deferred = False
         self.wrap_name = _binary_name[:16]
 
+        # Lines of every table as of the last successful apply, and the
+        # timer telling when they have to be checked against ebtables-save
+        self._applied_tables = None
+        self._resync_watch = None
+
+        # With debug_iptables_rules set, every
+        # ebtables_convergence_check_every-th apply is checked against
+        # ebtables-save. The totals tell what the checks cost and found.
+        self._applies_since_check = 0
+        self.convergence_checks = 0
+        self.convergence_check_time = 0.0
+        self.convergence_divergences = 0
+
         self.tables = {
             'filter': EbtablesTable(_binary_name=self.wrap_name),
             'broute': EbtablesTable(_binary_name=self.wrap_name)
@@ -335,28 +448,126 @@ class EbtablesManager(object):
         return self._apply()
 
     def _apply(self):
+        commands = self._apply_changes()
+        if cfg.CONF.AGENT.debug_iptables_rules:
+            self._applies_since_check += 1
+            if (self._applies_since_check >=
+                    cfg.CONF.ISOFLAT.ebtables_convergence_check_every):
+                self._applies_since_check = 0
+                self._check_convergence()
+        return commands
+
+    def _check_convergence(self):
+        """Compare what ebtables holds with the state applied last.
+
+        Instead of applying the rules a second time, a single ebtables-save
+        is compared chain by chain with the intended tables. Only our own
+        chains and the rules we put into other chains are compared, other
+        ebtables users are free to change the rest. Our rules diverging are
+        logged and applied again against the fresh save.
+        """
+        intended = self._applied_tables
+        if intended is None:
+            return
+        watch = timeutils.StopWatch()
+        watch.start()
+        # compare against what ebtables really holds, not the cached state
+        self.invalidate_applied_state()
+        current = self._save_tables('ebtables', intended)
+        if current is None:
+            return
+        divergences = []
+        for table_name in sorted(intended):
+            current_lines = self._get_owned_lines(table_name, current[table_name])
+            intended_lines = self._get_owned_lines(table_name, intended[table_name])
+            if _tables_differ({table_name: current_lines}, {table_name: intended_lines}):
+                divergences += _generate_path_between_rules(
+                    table_name, current_lines, intended_lines)
+        elapsed = watch.elapsed()
+        self.convergence_checks += 1
+        self.convergence_check_time += elapsed
+        self.convergence_divergences += len(divergences)
+        LOG.debug("Ebtables convergence check took %(elapsed).3fs and found "
+                  "%(divergences)d divergences (%(checks)d checks, "
+                  "%(total_time).3fs, %(total)d divergences in total)",
+                  {'elapsed': elapsed, 'divergences': len(divergences),
+                   'checks': self.convergence_checks,
+                   'total_time': self.convergence_check_time,
+                   'total': self.convergence_divergences})
+        self._applied_tables = current
+        if divergences:
+            LOG.warning("Ebtables Rules did not converge, applying them "
+                        "again. Diff: %s", '\n'.join(divergences))
+            self._apply_changes()
+
+    def _get_owned_lines(self, table_name, lines):
+        """Return the lines of a table which belong to this manager.
+
+        These are our wrapped and unwrapped chains with all their rules,
+        and the rules we put into other chains, like the jumps from the
+        builtin chains.
+        """
+        table = self.tables[table_name]
+        our_rules = set(map(str, table.rules))
+        owned = []
+        for line in lines:
+            if line.startswith(':'):
+                chain = line[1:].split(' ', 1)[0]
+                if (chain.startswith(self.wrap_name + '-') or
+                        chain in table.unwrapped_chains):
+                    owned.append(':%s' % chain)
+            elif line.startswith('-A'):
+                chain = line[3:].split(' ', 1)[0]
+                if (chain.startswith(self.wrap_name + '-') or
+                        chain in table.unwrapped_chains or
+                        line in our_rules or self.wrap_name in line):
+                    owned.append(line)
+        return owned
+
+    def _restore_lock(self):
         lock_name = 'ebtables'
         if self.namespace:
             lock_name += '-' + self.namespace
-
-        with lockutils.lock(lock_name, runtime.SYNCHRONIZED_PREFIX, True):
-            first = self._apply_synchronized()
-            if not cfg.CONF.AGENT.debug_iptables_rules:
-                return first
-            second = self._apply_synchronized()
-            if second:
-                msg = (_("Ebtables Rules did not converge. Diff: %s") %
-                       '\n'.join(second))
-                LOG.error(msg)
-                raise EbTablesApplyException(msg)
-            return first
+        return lockutils.lock(lock_name, runtime.SYNCHRONIZED_PREFIX, True)
 
     @property
     def xlock_wait_time(self):
         # give agent some time to report back to server
         return str(int(cfg.CONF.AGENT.report_interval / 3.0))
 
-    def _run_restore(self, args, commands):
+    @classmethod
+    def _atomic_restore_supported(cls, cmd):
+        if cls.atomic_restore_available is None:
+            cls.atomic_restore_available = bool(
+                _find_executable('%s-restore' % cmd))
+            if cls.atomic_restore_available:
+                LOG.debug("Using %s-restore to apply rules atomically", cmd)
+            else:
+                LOG.warning("%s-restore is not available, falling back to "
+                            "applying %s rules one command at a time",
+                            cmd, cmd)
+        return cls.atomic_restore_available
+
+    def _run_restore(self, args, commands, restore_lines):
+        """Apply the changes with a single privileged call when possible.
+
+        The full state of every changed table is fed to ebtables-restore,
+        which swaps each table in at once. Only when ebtables-restore is
+        missing are the diff commands run one by one instead.
+
+        Returns a tuple of the error, if any, and the lines that were applied.
+        """
+        if not self._atomic_restore_supported(args[-1]):
+            return self._run_commands(args, commands), commands
+        restore_args = args[:-1] + ['%s-restore' % args[-1]]
+        try:
+            self.execute(restore_args, process_input='\n'.join(restore_lines),
+                         run_as_root=True)
+        except RuntimeError as error:
+            return error, restore_lines
+        return None, restore_lines
+
+    def _run_commands(self, args, commands):
         try:
             table = None
             for command in commands:
@@ -365,11 +576,13 @@ class EbtablesManager(object):
                     continue
                 elif command.startswith('*'):
                     table = command[1:].strip()
+                    continue
                 elif command.startswith(':'):
                     # recreate the chain
                     chain = command[1:].strip()
-                    if chain not in STANDARD_CHAINS[table]:
-                        _args += ['-t', table, '-N', chain]
+                    if chain in STANDARD_CHAINS[table]:
+                        continue
+                    _args += ['-t', table, '-N', chain]
                 elif command.strip() != '':
                     _args += ['-t', table] + command.split(' ')
                 else:
@@ -398,68 +611,155 @@ class EbtablesManager(object):
                   "following set of ebtables rules:\n%s",
                   '\n'.join(log_lines))
 
-    def _apply_synchronized(self):
+    def _get_cached_tables(self):
+        """Return the lines of every table as this manager applied them last.
+
+        Returns None when there is no such state yet or it is older than
+        ebtables_resync_interval seconds, the tables are saved then.
+        """
+        if (self._applied_tables is not None and
+                self._resync_watch is not None and
+                not self._resync_watch.expired()):
+            return self._applied_tables
+        return None
+
+    def _save_tables(self, cmd, tables):
+        """Return the lines of every table as ebtables-save shows them.
+
+        Returns None if the namespace disappeared in the meantime.
+        """
+        args = ['%s-save' % (cmd,)]
+        if self.namespace:
+            args = ['ip', 'netns', 'exec', self.namespace] + args
+        try:
+            save_output = self.execute(args, run_as_root=True)
+        except RuntimeError:
+            # We could be racing with a cron job deleting namespaces.
+            # It is useless to try to apply ebtables rules over and
+            # over again in a endless loop if the namespace does not
+            # exist.
+            with excutils.save_and_reraise_exception() as ctx:
+                if self.namespace and not ip_lib.network_namespace_exists(self.namespace):
+                    ctx.reraise = False
+                    LOG.error("Namespace %s was deleted during ebtables "
+                              "operations.", self.namespace)
+                    return None
+        all_lines = save_output.split('\n')
+        current_tables = {}
+        for table_name in tables:
+            # isolate the lines of the table we are modifying
+            start, end = self._find_table(all_lines, table_name)
+            current_tables[table_name] = all_lines[start:end]
+
+        interval = cfg.CONF.ISOFLAT.ebtables_resync_interval
+        if interval > 0:
+            self._resync_watch = timeutils.StopWatch(duration=interval)
+            self._resync_watch.start()
+        return current_tables
+
+    def invalidate_applied_state(self):
+        """Forget the last applied state so the next apply saves again."""
+        self._applied_tables = None
+        self._resync_watch = None
+
+    def _diff_tables(self, tables, current_tables):
+        """Diff the in-memory rules against the lines of the current tables.
+
+        Returns the lines every table gets, the ebtables commands to get
+        there and the ebtables-restore input of the changed tables.
+        """
+        applied_tables = {}
+        commands = []
+        restore_lines = []
+        # Traverse tables in sorted order for predictable dump output
+        for table_name in sorted(tables):
+            table = tables[table_name]
+            old_rules = current_tables[table_name]
+            # generate the new table state we want
+            new_rules = self._modify_rules(old_rules, table)
+            applied_tables[table_name] = new_rules
+            # generate the ebtables commands to get between the old state
+            # and the new state
+            changes = _generate_path_between_rules(table_name, old_rules, new_rules)
+            if changes:
+                # if there are changes to the table, we put on the header
+                # and footer that ebtables-save needs
+                commands += (['# Generated by ebtables_manager'] +
+                             ['*%s' % table_name] + changes +
+                             ['# Completed by ebtables_manager'])
+                restore_lines += _generate_restore_lines(table_name,
+                                                         new_rules)
+        return applied_tables, commands, restore_lines
+
+    def _apply_changes(self):
         """Apply the current in-memory set of ebtables rules.
 
         This will create a diff between the rules from the previous runs
         and replace them with the current set of rules.
         This happens atomically, thanks to ebtables-restore.
 
+        While the state applied last is fresh, the rules are diffed against
+        it outside the host wide ebtables lock, and an update without
+        changes runs no ebtables-save at all. ebtables-restore replaces
+        whole tables though, so an update with changes still runs a single
+        ebtables-save under the lock before the restore, and when another
+        ebtables user changed the tables the rules are diffed again against
+        what they hold now. Without a fresh state the rules are diffed
+        against that save right away.
+
         Returns a list of the changes that were sent to ebtables-save.
         """
         s = [('ebtables', self.tables)]
         all_commands = []  # variable to keep track all commands for return val
         for cmd, tables in s:
-            args = ['%s-save' % (cmd,)]
+            args = [cmd]
             if self.namespace:
                 args = ['ip', 'netns', 'exec', self.namespace] + args
+            cached_tables = self._get_cached_tables()
             try:
-                save_output = self.execute(args, run_as_root=True)
-            except RuntimeError:
-                # We could be racing with a cron job deleting namespaces.
-                # It is useless to try to apply ebtables rules over and
-                # over again in a endless loop if the namespace does not
-                # exist.
-                with excutils.save_and_reraise_exception() as ctx:
-                    if self.namespace and not ip_lib.network_namespace_exists(self.namespace):
-                        ctx.reraise = False
-                        LOG.error("Namespace %s was deleted during ebtables "
-                                  "operations.", self.namespace)
+                if cached_tables is not None:
+                    applied_tables, commands, restore_lines = self._diff_tables(
+                        tables, cached_tables)
+                    if not commands:
+                        self._applied_tables = applied_tables
+                        continue
+
+                with self._restore_lock():
+                    saved_tables = self._save_tables(cmd, tables)
+                    if saved_tables is None:
+                        self.invalidate_applied_state()
                         return []
-            all_lines = save_output.split('\n')
-            commands = []
-            # Traverse tables in sorted order for predictable dump output
-            for table_name in sorted(tables):
-                table = tables[table_name]
-                # isolate the lines of the table we are modifying
-                start, end = self._find_table(all_lines, table_name)
-                old_rules = all_lines[start:end]
-                # generate the new table state we want
-                new_rules = self._modify_rules(old_rules, table)
-                # generate the ebtables commands to get between the old state
-                # and the new state
-                changes = _generate_path_between_rules(table_name, old_rules, new_rules)
-                if changes:
-                    # if there are changes to the table, we put on the header
-                    # and footer that ebtables-save needs
-                    commands += (['# Generated by ebtables_manager'] +
-                                 ['*%s' % table_name] + changes +
-                                 ['# Completed by ebtables_manager'])
-            if not commands:
-                continue
+                    if (cached_tables is None or
+                            _tables_differ(saved_tables, cached_tables)):
+                        if cached_tables is not None:
+                            LOG.debug("Ebtables changed since the rules "
+                                      "were applied last, diffing them "
+                                      "again")
+                        applied_tables, commands, restore_lines = (
+                            self._diff_tables(tables, saved_tables))
+                        if not commands:
+                            self._applied_tables = applied_tables
+                            continue
+                    # always end with a new line
+                    commands.append('')
+                    restore_lines.append('')
+                    err, applied_lines = self._run_restore(args, commands,
+                                                           restore_lines)
+            finally:
+                # flush lists, just in case a rule or chain marked for
+                # removal was already gone. (chains is a set, rules is a
+                # list)
+                for table in tables.values():
+                    table.remove_chains.clear()
+                    table.remove_rules = []
             all_commands += commands
-
-            # always end with a new line
-            commands.append('')
-
-            args = [cmd]
-            if self.namespace:
-                args = ['ip', 'netns', 'exec', self.namespace] + args
-
-            err = self._run_restore(args, commands)
             if err:
-                self._log_restore_err(err, commands)
+                # the tables may be partially applied, don't trust the
+                # cached state any longer
+                self.invalidate_applied_state()
+                self._log_restore_err(err, applied_lines)
                 raise err
+            self._applied_tables = applied_tables
 
         LOG.debug("EbtablesManager.apply completed with success. %d ebtables "
                   "commands were issued", len(all_commands))
@@ -508,7 +808,8 @@ class EbtablesManager(object):
         # Sort the output chains here to make their order predictable.
         unwrapped_chains = sorted(table.unwrapped_chains)
         chains = sorted(table.chains)
-        rules = set(map(str, table.rules))
+        table_rules = table.rules
+        rules = set(map(str, table_rules))
 
         # we don't want to change any rules that don't belong to us so we start
         # the new_filter with these rules
@@ -516,9 +817,17 @@ class EbtablesManager(object):
         # name. we want to add them in the right location in case our new rules
         # changed the order
         # (e.g. '-A FORWARD -j neutron-filter-top')
-        new_filter = [line.strip() for line in current_lines
-                      if self.wrap_name not in line and
-                      line.strip() not in rules]
+        new_filter = []
+        existing_chains = set()
+        for line in current_lines:
+            if self.wrap_name in line:
+                continue
+            line = line.strip()
+            if line in rules:
+                continue
+            new_filter.append(line)
+            if line.startswith(':'):
+                existing_chains.add(line[1:].split(' ', 1)[0])
 
         # generate our list of chain names
         our_chains = [':%s-%s' % (self.wrap_name, name) for name in chains]
@@ -527,18 +836,16 @@ class EbtablesManager(object):
         # the new_filter since they aren't marked by the wrap_name so we only
         # want to add them if they arent' already there
         our_chains += [':%s' % name for name in unwrapped_chains
-                       if not any(':%s' % name in s for s in new_filter)]
+                       if name not in existing_chains]
 
         our_top_rules = []
         our_bottom_rules = []
-        for rule in table.rules:
-            rule_str = str(rule)
-
+        for rule in table_rules:
             if rule.top:
                 # rule.top == True means we want this rule to be at the top.
-                our_top_rules += [rule_str]
+                our_top_rules.append(str(rule))
             else:
-                our_bottom_rules += [rule_str]
+                our_bottom_rules.append(str(rule))
 
         our_chains_and_rules = our_chains + our_top_rules + our_bottom_rules
 
@@ -547,50 +854,35 @@ class EbtablesManager(object):
         rules_index = self._find_rules_index(new_filter)
         new_filter[rules_index:rules_index] = our_chains_and_rules
 
-        def _weed_out_removes(line):
-            # remove any rules or chains from the filter that were slated
-            # for removal
-            if line.startswith(':'):
-                chain = line[1:]
-                if chain in table.remove_chains:
-                    table.remove_chains.remove(chain)
-                    return False
-            else:
-                if line in table.remove_rules:
-                    table.remove_rules.remove(line)
-                    return False
-            # Leave it alone
-            return True
-
+        # TODO(kevinbenton): remove the duplicate sweep and the removal of
+        # lines slated for removal. They are just oversized brooms to sweep
+        # bugs under the rug!!! We generate the rules and we shouldn't be
+        # generating duplicates.
+        # Walk backwards so that the last copy of a duplicated line is kept.
+        remove_chains = table.remove_chains
+        remove_rules = set(table.remove_rules)
         seen_lines = set()
-
-        # TODO(kevinbenton): remove this function and the next one. They are
-        # just oversized brooms to sweep bugs under the rug!!! We generate the
-        # rules and we shouldn't be generating duplicates.
-        def _weed_out_duplicates(line):
+        kept_lines = []
+        for line in reversed(new_filter):
             if line in seen_lines:
                 thing = 'chain' if line.startswith(':') else 'rule'
                 LOG.warning("Duplicate ebtables %(thing)s detected. This "
                             "may indicate a bug in the ebtables "
                             "%(thing)s generation code. Line: %(line)s",
                             {'thing': thing, 'line': line})
-                return False
+                continue
             seen_lines.add(line)
-            # Leave it alone
-            return True
-
-        new_filter.reverse()
-        new_filter = [line for line in new_filter
-                      if _weed_out_duplicates(line) and
-                      _weed_out_removes(line)]
-        new_filter.reverse()
-
-        # flush lists, just in case a rule or chain marked for removal
-        # was already gone. (chains is a set, rules is a list)
-        table.remove_chains.clear()
-        table.remove_rules = []
+            # remove any rules or chains from the filter that were slated
+            # for removal, chains are listed with their policy
+            if line.startswith(':'):
+                if line[1:].split(' ', 1)[0] in remove_chains:
+                    continue
+            elif line in remove_rules:
+                continue
+            kept_lines.append(line)
+        kept_lines.reverse()
 
-        return new_filter
+        return kept_lines
 
 
 def _generate_path_between_rules(table_name, old_rules, new_rules):
@@ -626,6 +918,37 @@ def _generate_path_between_rules(table_name, old_rules, new_rules):
     return statements
 
 
+def _generate_restore_lines(table_name, rules):
+    """Generates the ebtables-restore input for the full state of a table.
+
+    ebtables-restore replaces the whole table, so every chain has to be
+    declared with a policy before any rule is appended to it.
+    """
+    chains = []
+    appends = []
+    for line in rules:
+        if line.startswith(':'):
+            chain = line[1:].split(' ', 1)
+            if len(chain) == 1:
+                # chains we declare ourselves carry no policy
+                policy = ('ACCEPT' if chain[0] in STANDARD_CHAINS[table_name]
+                          else 'RETURN')
+                line = ':%s %s' % (chain[0], policy)
+            chains.append(line)
+        elif line.startswith('-A'):
+            appends.append(line)
+    return ['*%s' % table_name] + chains + appends
+
+
+def _find_executable(name):
+    paths = os.environ.get('PATH', '').split(os.pathsep) + list(SBIN_DIRS)
+    for path in paths:
+        candidate = os.path.join(path, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
 def _get_rules_by_chain(rules):
     by_chain = collections.defaultdict(list)
     for line in rules:
@@ -642,23 +965,130 @@ def _get_rules_by_chain(rules):
     return by_chain
 
 
+def _tables_differ(tables, other_tables, table_names=None):
+    """Whether the chains or rules of the tables differ, policies aside."""
+    for table_name in table_names or tables:
+        if (_get_rules_by_chain(tables[table_name]) !=
+                _get_rules_by_chain(other_tables[table_name])):
+            return True
+    return False
+
+
+def _diff_rule_sequences(old, new):
+    """Computes an edit script turning the old rule lines into the new ones.
+
+    Returns a list of (op, line) tuples in order, where op is ' ' for a line
+    kept, '-' for a line deleted and '+' for a line inserted.
+
+    Rules are compared as whole lines, there is no intraline analysis like
+    difflib.ndiff does. Common leading and trailing lines are skipped, then
+    the lines occurring exactly once on both sides are matched through the
+    longest increasing subsequence of their old positions and the gaps in
+    between are diffed the same way. This takes O(n log n) and yields the
+    minimal script whenever a chain holds no duplicate rules, which is the
+    case for the chains we generate.
+    """
+    ops = []
+    # pending work, popped in order: ('=', line) emits a kept line and
+    # (old_lo, old_hi, new_lo, new_hi) diffs a region of both sequences
+    stack = [(0, len(old), 0, len(new))]
+    while stack:
+        item = stack.pop()
+        if item[0] == '=':
+            ops.append((' ', item[1]))
+            continue
+        old_lo, old_hi, new_lo, new_hi = item
+        while (old_lo < old_hi and new_lo < new_hi and
+               old[old_lo] == new[new_lo]):
+            ops.append((' ', old[old_lo]))
+            old_lo += 1
+            new_lo += 1
+        suffix = []
+        while (old_lo < old_hi and new_lo < new_hi and
+               old[old_hi - 1] == new[new_hi - 1]):
+            old_hi -= 1
+            new_hi -= 1
+            suffix.append(('=', old[old_hi]))
+        # suffix is in reverse order already, as the stack wants it
+        stack += suffix
+
+        anchors = _unique_common_lines(old, old_lo, old_hi,
+                                       new, new_lo, new_hi)
+        if not anchors:
+            ops += [('-', line) for line in old[old_lo:old_hi]]
+            ops += [('+', line) for line in new[new_lo:new_hi]]
+            continue
+        # push the gaps and anchors backwards so they pop in order
+        stack.append((anchors[-1][0] + 1, old_hi, anchors[-1][1] + 1, new_hi))
+        for i in range(len(anchors) - 1, 0, -1):
+            old_idx, new_idx = anchors[i]
+            prev_old_idx, prev_new_idx = anchors[i - 1]
+            stack.append(('=', old[old_idx]))
+            stack.append((prev_old_idx + 1, old_idx, prev_new_idx + 1, new_idx))
+        stack.append(('=', old[anchors[0][0]]))
+        stack.append((old_lo, anchors[0][0], new_lo, anchors[0][1]))
+    return ops
+
+
+def _unique_common_lines(old, old_lo, old_hi, new, new_lo, new_hi):
+    """Matches the lines unique to both regions, keeping their order.
+
+    Returns the longest list of (old_index, new_index) pairs, increasing on
+    both indexes, among the lines that occur once in old[old_lo:old_hi] and
+    once in new[new_lo:new_hi].
+    """
+    old_positions = {}
+    for i in range(old_lo, old_hi):
+        line = old[i]
+        old_positions[line] = None if line in old_positions else i
+    new_positions = {}
+    for j in range(new_lo, new_hi):
+        line = new[j]
+        if line in old_positions:
+            new_positions[line] = None if line in new_positions else j
+    pairs = [(old_positions[line], j) for line, j in new_positions.items()
+             if j is not None and old_positions[line] is not None]
+    if not pairs:
+        return []
+    pairs.sort(key=lambda pair: pair[1])
+
+    # longest increasing subsequence of the old indexes (patience sorting)
+    tails = []
+    tail_pairs = []
+    previous = [None] * len(pairs)
+    for k, pair in enumerate(pairs):
+        pos = bisect.bisect_left(tails, pair[0])
+        if pos:
+            previous[k] = tail_pairs[pos - 1]
+        if pos == len(tails):
+            tails.append(pair[0])
+            tail_pairs.append(k)
+        else:
+            tails[pos] = pair[0]
+            tail_pairs[pos] = k
+    anchors = []
+    k = tail_pairs[-1]
+    while k is not None:
+        anchors.append(pairs[k])
+        k = previous[k]
+    anchors.reverse()
+    return anchors
+
+
 def _generate_chain_diff_ebtables_commands(chain, old_chain_rules, new_chain_rules):
     # keep track of the old index because we have to insert rules
     # in the right position
     old_index = 1
     statements = []
-    for line in difflib.ndiff(old_chain_rules, new_chain_rules):
-        if line.startswith('?'):
-            # skip ? because that's a guide string for intraline differences
-            continue
-        elif line.startswith('-'):  # line deleted
+    for op, line in _diff_rule_sequences(old_chain_rules, new_chain_rules):
+        if op == '-':  # line deleted
             statements.append('-D %s %d' % (chain, old_index))
             # since we are removing a line from the old rules, we
             # backup the index by 1
             old_index -= 1
-        elif line.startswith('+'):  # line added
+        elif op == '+':  # line added
             # strip the chain name since we have to add it before the index
-            rule = line[5:].split(' ', 1)[-1]
+            rule = line[3:].split(' ', 1)[-1]
             # EbtableRule does not add trailing spaces for rules, so we
             # have to detect that here by making sure this chain isn't
             # referencing itself
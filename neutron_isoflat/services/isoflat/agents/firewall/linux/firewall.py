@@ -1,4 +1,5 @@
 import abc
+import contextlib
 
 import six
 from neutron_lib.utils import runtime
@@ -22,4 +23,13 @@ class FirewallDriver(object):
     def update_firewall_rules(self, device, physical_network, isoflat_rules):
         """
         Update firewall rules for a specific port.
-        """
\ No newline at end of file
+        """
+
+    @contextlib.contextmanager
+    def defer_apply(self):
+        """
+        Apply the rule updates made inside the context all at once on exit.
+
+        Drivers which cannot defer apply every update right away.
+        """
+        yield
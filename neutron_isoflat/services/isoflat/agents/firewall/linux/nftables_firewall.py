@@ -0,0 +1,281 @@
+import collections
+import contextlib
+import hashlib
+import re
+
+from neutron.agent.linux import utils as linux_utils
+from neutron_lib import constants
+from oslo_log import log as logging
+from oslo_utils import excutils
+
+from neutron_isoflat.services.isoflat.agents.firewall.linux import firewall
+from neutron_isoflat.services.isoflat.agents.firewall.linux import rule_compiler
+
+LOG = logging.getLogger(__name__)
+
+TABLE = 'bridge neutron-isoflat'
+# NF_BR_PRI_FILTER_BRIDGED, the priority ebtables' filter table hooks at
+BASE_CHAIN_PRIORITY = -200
+BASE_CHAINS = ('input', 'forward', 'output')
+CHAIN_NAME_PREFIX = {constants.INGRESS_DIRECTION: 'i-',
+                     constants.EGRESS_DIRECTION: 'o-'}
+IP_MATCH = {4: 'ip', 6: 'ip6'}
+PROTOCOL_MATCH = {4: 'ip protocol', 6: 'ip6 nexthdr'}
+ICMP_MATCH = {4: 'icmp', 6: 'icmpv6'}
+ADDR_TYPE = {4: 'ipv4_addr', 6: 'ipv6_addr'}
+ICMP_PROTOCOLS = ('icmp', 'ipv6-icmp')
+# characters nft accepts in unquoted names
+INVALID_NAME_CHARS = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+class NftablesFirewall(firewall.FirewallDriver):
+    """Isoflat firewall driver based on nftables bridge family tables.
+
+    Every (physical network, direction) gets a chain in the bridge family
+    table. Remote CIDRs and port ranges are kept in named interval sets, so
+    the chains hold one rule per group of matches instead of one rule per
+    remote address and port. Each update is a single atomic 'nft -f'
+    transaction which, when only addresses or ports change, only adds and
+    deletes set elements and leaves the chains alone.
+    """
+
+    def __init__(self):
+        # (physical_network, direction) -> {'sets': {name: (type, elements)},
+        #                                   'rules': [rule, ...]}
+        self._chains = {}
+        # physical_network -> device its traffic is filtered on
+        self._devices = {}
+        # scripts of the updates made in a defer_apply context
+        self._deferred_scripts = None
+
+    @staticmethod
+    def _execute(script):
+        try:
+            linux_utils.execute(['nft', '-f', '-'], process_input=script,
+                                run_as_root=True)
+        except RuntimeError:
+            with excutils.save_and_reraise_exception():
+                LOG.error("Failed to apply the following nftables "
+                          "transaction:\n%s", script)
+
+    @contextlib.contextmanager
+    def defer_apply(self):
+        """Send the updates made inside the context as a single transaction."""
+        chains, devices = dict(self._chains), dict(self._devices)
+        self._deferred_scripts = []
+        try:
+            yield
+            scripts, self._deferred_scripts = self._deferred_scripts, None
+            if scripts:
+                self._execute(''.join(scripts))
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                # none of the updates went in
+                self._deferred_scripts = None
+                self._chains, self._devices = chains, devices
+
+    @staticmethod
+    def _network_chain_name(physical_network, direction):
+        return '%s%s' % (CHAIN_NAME_PREFIX[direction],
+                         INVALID_NAME_CHARS.sub('_', physical_network))
+
+    def init_firewall(self):
+        # start from a clean table, the 'add' makes the 'delete' safe
+        commands = ['add table %s' % TABLE, 'delete table %s' % TABLE,
+                    'add table %s' % TABLE]
+        for chain in BASE_CHAINS:
+            commands.append('add chain %s %s { type filter hook %s '
+                            'priority %d; policy accept; }' %
+                            (TABLE, chain, chain, BASE_CHAIN_PRIORITY))
+        self._execute('\n'.join(commands) + '\n')
+
+    @staticmethod
+    def _get_ports(protocol, port_range_min, port_range_max):
+        if port_range_min is None:
+            return None
+        if protocol in ICMP_PROTOCOLS:
+            # port_range_min/port_range_max represent icmp type/code
+            return 'icmp', port_range_min, port_range_max
+        if port_range_max is None:
+            port_range_max = port_range_min
+        return port_range_min, port_range_max
+
+    @staticmethod
+    def _merge_port_ranges(port_ranges):
+        merged = []
+        for low, high in sorted(port_ranges):
+            if merged and low <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], high)
+            else:
+                merged.append([low, high])
+        return tuple('%d' % low if low == high else '%d-%d' % (low, high)
+                     for low, high in merged)
+
+    def _group_matches(self, isoflat_rules, direction):
+        """Group the rules of a direction by what they match besides addresses.
+
+        Returns a dict of (ip_version, protocol, ports) -> list of CIDRs.
+        """
+        rules, removed = rule_compiler.compile_rules(
+            [rule for rule in isoflat_rules if rule['direction'] == direction])
+        LOG.debug("Compiled %d %s rules, %d redundant rules removed",
+                  len(rules), direction, removed)
+        cidrs_by_match = collections.defaultdict(list)
+        for rule in rules:
+            ip_version = 4 if rule['ethertype'] == constants.IPv4 else 6
+            ports = self._get_ports(rule['protocol'], rule['port_range_min'],
+                                    rule['port_range_max'])
+            cidrs_by_match[(ip_version, rule['protocol'], ports)].append(
+                rule['remote_ip'])
+        return cidrs_by_match
+
+    @staticmethod
+    def _group_sort_key(group):
+        ip_version, protocol, ports, addrs = group[0]
+        return ip_version, protocol or '', str(ports), sorted(addrs)
+
+    def _compile_chain(self, chain_name, isoflat_rules, direction):
+        """Compile the rules of a direction into nftables sets and rules.
+
+        Returns a dict of set name -> (set type, frozenset of elements) and
+        the list of rules of the chain.
+        """
+        if direction == constants.INGRESS_DIRECTION:
+            addr_match, port_match = 'saddr', 'sport'
+        else:
+            addr_match, port_match = 'daddr', 'dport'
+
+        # the port ranges dropped for the very same addresses are merged
+        # into a single rule
+        groups = collections.defaultdict(list)
+        for (ip_version, protocol, ports), cidrs in self._group_matches(
+                isoflat_rules, direction).items():
+            addrs = frozenset(cidrs)
+            if ports is None or ports[0] == 'icmp':
+                groups[(ip_version, protocol, ports, addrs)] = None
+            else:
+                groups[(ip_version, protocol, 'ports', addrs)].append(ports)
+
+        sets = {}
+        rules = []
+        for (ip_version, protocol, ports, addrs), port_ranges in sorted(
+                groups.items(), key=self._group_sort_key):
+            name = '%s-v%d-%s' % (chain_name, ip_version,
+                                  INVALID_NAME_CHARS.sub('_', protocol or 'any'))
+            matches = []
+            if protocol:
+                matches.append('%s %s' % (PROTOCOL_MATCH[ip_version], protocol))
+            if ports == 'ports':
+                port_elements = self._merge_port_ranges(port_ranges)
+                # name the sets after the ports, addresses are what
+                # changes most, and they are then updated in place
+                name += '-%s' % hashlib.md5(
+                    ','.join(port_elements).encode('utf-8')).hexdigest()[:8]
+                while name in sets:
+                    name += '_'
+                sets[name + '-ports'] = ('inet_service',
+                                         frozenset(port_elements))
+                matches.append('th %s @%s-ports' % (port_match, name))
+            elif ports is not None:
+                _icmp, icmp_type, icmp_code = ports
+                name += '-t%s' % icmp_type
+                matches.append('%s type %s' % (ICMP_MATCH[ip_version],
+                                               icmp_type))
+                if icmp_code is not None:
+                    name += 'c%s' % icmp_code
+                    matches.append('%s code %s' % (ICMP_MATCH[ip_version],
+                                                   icmp_code))
+            sets[name] = (ADDR_TYPE[ip_version], addrs)
+            matches.insert(0, '%s %s @%s' % (IP_MATCH[ip_version],
+                                             addr_match, name))
+            rules.append(' '.join(matches + ['drop']))
+        return sets, rules
+
+    @staticmethod
+    def _element_commands(action, name, elements):
+        if not elements:
+            return []
+        return ['%s element %s %s { %s }' % (action, TABLE, name,
+                                             ', '.join(sorted(elements)))]
+
+    def _jump_commands(self, devices):
+        commands = ['flush chain %s %s' % (TABLE, chain)
+                    for chain in BASE_CHAINS]
+        for physical_network, device in sorted(devices.items()):
+            ingress_chain = self._network_chain_name(
+                physical_network, constants.INGRESS_DIRECTION)
+            egress_chain = self._network_chain_name(
+                physical_network, constants.EGRESS_DIRECTION)
+            commands += [
+                'add rule %s input iifname "%s" jump %s' % (
+                    TABLE, device, egress_chain),
+                'add rule %s forward iifname "%s" jump %s' % (
+                    TABLE, device, egress_chain),
+                'add rule %s forward oifname "%s" jump %s' % (
+                    TABLE, device, ingress_chain),
+                'add rule %s output oifname "%s" jump %s' % (
+                    TABLE, device, ingress_chain),
+            ]
+        return commands
+
+    def update_firewall_rules(self, device, physical_network, isoflat_rules):
+        # the transaction creates chains and sets first, then rewrites the
+        # rules and only then deletes the sets no rule references any more
+        add_chain_commands = []
+        set_commands = []
+        rule_commands = []
+        delete_commands = []
+        chains = {}
+        for direction in (constants.INGRESS_DIRECTION,
+                          constants.EGRESS_DIRECTION):
+            key = (physical_network, direction)
+            chain_name = self._network_chain_name(physical_network, direction)
+            sets, rules = self._compile_chain(chain_name, isoflat_rules,
+                                              direction)
+            chains[key] = {'sets': sets, 'rules': rules}
+            installed = self._chains.get(key)
+            if installed is None:
+                installed = {'sets': {}, 'rules': None}
+                add_chain_commands.append('add chain %s %s' % (TABLE, chain_name))
+
+            for name, (set_type, elements) in sorted(sets.items()):
+                if name in installed['sets']:
+                    old_elements = installed['sets'][name][1]
+                else:
+                    set_commands.append(
+                        'add set %s %s { type %s; flags interval; }' % (
+                            TABLE, name, set_type))
+                    old_elements = frozenset()
+                set_commands += self._element_commands(
+                    'delete', name, old_elements - elements)
+                set_commands += self._element_commands(
+                    'add', name, elements - old_elements)
+
+            if rules != installed['rules']:
+                rule_commands.append('flush chain %s %s' % (TABLE, chain_name))
+                rule_commands += ['add rule %s %s %s' % (TABLE, chain_name, rule)
+                                  for rule in rules]
+            delete_commands += ['delete set %s %s' % (TABLE, name)
+                                for name in sorted(installed['sets'])
+                                if name not in sets]
+
+        devices = dict(self._devices)
+        devices[physical_network] = device
+        jump_commands = []
+        if devices != self._devices:
+            jump_commands = self._jump_commands(devices)
+
+        commands = (add_chain_commands + set_commands + rule_commands +
+                    delete_commands + jump_commands)
+        if commands:
+            script = '\n'.join(commands) + '\n'
+            if self._deferred_scripts is None:
+                self._execute(script)
+            else:
+                self._deferred_scripts.append(script)
+        # the transaction is atomic, the state only changes once it went in,
+        # or is restored by defer_apply when it did not
+        self._chains.update(chains)
+        self._devices = devices
+        LOG.debug("Applied %d nftables commands for physical network %s",
+                  len(commands), physical_network)
@@ -0,0 +1,185 @@
+import collections
+
+import netaddr
+from neutron.common import constants as n_const
+from neutron_lib import constants
+
+IP_VERSIONS = {constants.IPv4: 4, constants.IPv6: 6}
+ICMP_PROTOCOLS = ('icmp', 'ipv6-icmp')
+
+
+def _normalize_protocol(protocol, ip_version):
+    protocol = n_const.IPTABLES_PROTOCOL_NAME_MAP.get(protocol, protocol)
+    if ip_version == 6 and protocol == 'icmp':
+        protocol = 'ipv6-icmp'
+    return protocol
+
+
+def _get_ports(protocol, port_range_min, port_range_max):
+    """Return the (min, max) ports a rule matches, None for all of them.
+
+    For icmp the pair is the icmp type and code, the code may be None.
+    """
+    if port_range_min is None:
+        return None
+    if port_range_max is None and protocol not in ICMP_PROTOCOLS:
+        port_range_max = port_range_min
+    return port_range_min, port_range_max
+
+
+def _get_cidr(remote_ip, ip_version):
+    """Return the network a remote IP matches in the rule's IP version.
+
+    Returns None when it cannot match any traffic of that version.
+    """
+    if not remote_ip:
+        return netaddr.IPNetwork('::/0' if ip_version == 6 else '0.0.0.0/0')
+    cidr = netaddr.IPNetwork(remote_ip).cidr
+    if cidr.version != ip_version:
+        # rules without remote IP are handed over as 0.0.0.0/0 whatever
+        # their ethertype, any other address of the other version is not
+        # a match for this rule at all
+        if cidr.prefixlen:
+            return None
+        cidr = _get_cidr(None, ip_version)
+    return cidr
+
+
+def _ports_cover(protocol, ports, other_ports):
+    if ports is None:
+        return True
+    if other_ports is None:
+        return False
+    if protocol in ICMP_PROTOCOLS:
+        return (ports[0] == other_ports[0] and
+                (ports[1] is None or ports[1] == other_ports[1]))
+    return ports[0] <= other_ports[0] and other_ports[1] <= ports[1]
+
+
+def _covers(match, other_match):
+    """Whether everything other_match drops is dropped by match as well."""
+    protocol, ports = match
+    other_protocol, other_ports = other_match
+    if protocol is None:
+        return ports is None
+    return (protocol == other_protocol and
+            _ports_cover(protocol, ports, other_ports))
+
+
+def _merge_cidrs(cidrs_by_match):
+    """Merge the adjacent and contained networks of every match."""
+    changed = False
+    for match, cidrs in cidrs_by_match.items():
+        merged = set(netaddr.cidr_merge(cidrs))
+        if merged != cidrs:
+            cidrs_by_match[match] = merged
+            changed = True
+    return changed
+
+
+def _merge_port_ranges(cidrs_by_match):
+    """Merge overlapping and contiguous port ranges of the same network."""
+    ranges_by_cidr = collections.defaultdict(list)
+    for (protocol, ports), cidrs in cidrs_by_match.items():
+        if ports is None or protocol in ICMP_PROTOCOLS:
+            continue
+        for cidr in cidrs:
+            ranges_by_cidr[(protocol, cidr)].append(ports)
+
+    changed = False
+    for (protocol, cidr), port_ranges in ranges_by_cidr.items():
+        if len(port_ranges) < 2:
+            continue
+        merged = []
+        for low, high in sorted(port_ranges):
+            if merged and low <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], high)
+            else:
+                merged.append([low, high])
+        if len(merged) == len(port_ranges):
+            continue
+        changed = True
+        for ports in port_ranges:
+            cidrs_by_match[(protocol, ports)].discard(cidr)
+        for low, high in merged:
+            cidrs_by_match.setdefault((protocol, (low, high)), set()).add(cidr)
+    for match in [match for match, cidrs in cidrs_by_match.items()
+                  if not cidrs]:
+        del cidrs_by_match[match]
+    return changed
+
+
+def _remove_shadowed(cidrs_by_match):
+    """Drop the networks of a match a broader match already drops."""
+    for match in list(cidrs_by_match):
+        covering = [netaddr.IPSet(cidrs)
+                    for other, cidrs in cidrs_by_match.items()
+                    if other != match and _covers(other, match)]
+        if not covering:
+            continue
+        cidrs_by_match[match] = set(
+            cidr for cidr in cidrs_by_match[match]
+            if not any(cidr in addresses for addresses in covering))
+        if not cidrs_by_match[match]:
+            del cidrs_by_match[match]
+
+
+def _sort_key(match):
+    protocol, ports = match
+    # the icmp code may be None
+    return protocol or '', tuple(-1 if port is None else port
+                                 for port in ports or ())
+
+
+def compile_rules(isoflat_rules):
+    """Compile isoflat rules into the fewest rules dropping the same traffic.
+
+    Every remote IP of the isoflat rules ends up in a rule of its own,
+    returned as a rule dict with a single 'remote_ip'. On the way networks
+    contained in or adjacent to each other are merged, port ranges of the
+    same network are joined and rules a broader rule already covers are
+    dropped. As all the rules drop traffic their order does not matter,
+    they are returned sorted so the same input always gives the same rules.
+
+    Returns the compiled rules and how many rules were saved compared to
+    one rule per remote IP.
+    """
+    # (direction, ip_version) -> (protocol, ports) -> set of networks
+    groups = collections.defaultdict(dict)
+    expanded = 0
+    for rule in isoflat_rules:
+        ip_version = IP_VERSIONS.get(rule.get('ethertype'))
+        if ip_version is None:
+            continue
+        protocol = _normalize_protocol(rule.get('protocol'), ip_version)
+        ports = _get_ports(protocol, rule.get('port_range_min'),
+                           rule.get('port_range_max'))
+        cidrs = groups[(rule['direction'], ip_version)].setdefault(
+            (protocol, ports), set())
+        for remote_ip in rule['remote_ips']:
+            expanded += 1
+            cidr = _get_cidr(remote_ip, ip_version)
+            if cidr is not None:
+                cidrs.add(cidr)
+
+    compiled_rules = []
+    for (direction, ip_version), cidrs_by_match in sorted(groups.items()):
+        # merging port ranges may make networks adjacent and the other way
+        # round, repeat until neither finds anything left to merge
+        _merge_cidrs(cidrs_by_match)
+        while _merge_port_ranges(cidrs_by_match):
+            if not _merge_cidrs(cidrs_by_match):
+                break
+        _remove_shadowed(cidrs_by_match)
+        for protocol, ports in sorted(cidrs_by_match, key=_sort_key):
+            for cidr in sorted(cidrs_by_match[(protocol, ports)]):
+                compiled_rules.append({
+                    'direction': direction,
+                    'ethertype': (constants.IPv4 if ip_version == 4
+                                  else constants.IPv6),
+                    'protocol': protocol,
+                    'port_range_min': ports[0] if ports else None,
+                    'port_range_max': ports[1] if ports else None,
+                    'remote_ip': str(cidr),
+                })
+    return compiled_rules, expanded - len(compiled_rules)
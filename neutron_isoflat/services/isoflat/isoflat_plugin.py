@@ -1,23 +1,32 @@
+from neutron.db import api as db_api
 from neutron.db import servicetype_db as st_db
 from neutron.services import provider_configuration as pconf
 from neutron.services import service_base
 from neutron_lib import exceptions as n_exc
+from neutron_lib.callbacks import events
+from neutron_lib.callbacks import registry
+from neutron_lib.callbacks import resources
 from oslo_log import log as logging
 from oslo_utils import excutils
 
 from neutron_isoflat.common import constants
+from neutron_isoflat.common import utils
 from neutron_isoflat.db import isoflat_db
 from neutron_isoflat.extensions import isoflat
 
 LOG = logging.getLogger(__name__)
 
+# attribute of the request context holding the networks it deletes
+DELETED_NETWORKS_ATTR = '_isoflat_deleted_networks'
+
 
-# TODO: on remote network subnet changes, refresh isoflat rules
 class IsoflatPlugin(isoflat_db.IsoflatDbMixin):
 
     supported_extension_aliases = ["isoflat"]
     path_prefix = "/isoflat"
 
+    __native_bulk_support = True
+
     @staticmethod
     def _check_network_type(network):
         if network['provider:network_type'] != 'flat':
@@ -28,16 +37,32 @@ class IsoflatPlugin(isoflat_db.IsoflatDbMixin):
             raise isoflat.NotAuthorizedToEditRule(network_id=network['id'])
         self._check_network_type(network)
 
-    def _prepare_rule_dict_for_agent(self, context, rule, physical_network):
+    def _get_networks_details(self, context, network_ids):
+        """Get many networks in a single lookup, keyed by their id."""
+        network_ids = set(network_ids)
+        with context.session.begin(subtransactions=True):
+            networks = self._core_plugin().get_networks(context, filters={'id': list(network_ids)})
+        networks = dict((network['id'], network) for network in networks)
+        for network_id in network_ids - set(networks):
+            raise n_exc.NetworkNotFound(net_id=network_id)
+        return networks
+
+    def _prepare_rule_dict_for_agent(self, context, rule, physical_network, subnet_cidrs=None):
+        """
+        :param subnet_cidrs: subnet CIDRs by network id, the subnets of the
+            remote network are queried when not given
+        """
         if rule['remote_ip'] is not None:
             remote_ips = [rule['remote_ip']]
         elif rule.get('remote_network_id', None) is not None:
             # get subnets and ips
-            subnets = self._get_subnets(context, rule['remote_network_id'])
-            remote_ips = [subnet['cidr'] for subnet in subnets]
+            if subnet_cidrs is None:
+                subnet_cidrs = self._get_subnet_cidrs_by_network(context, [rule['remote_network_id']])
+            remote_ips = list(subnet_cidrs.get(rule['remote_network_id'], []))
         else:
             remote_ips = ['0.0.0.0/0']
         return {
+            'id': rule['id'],
             'physical_network': physical_network,
             'direction': rule['direction'],
             'protocol': rule['protocol'],
@@ -58,33 +83,256 @@ class IsoflatPlugin(isoflat_db.IsoflatDbMixin):
         else:
             raise n_exc.Invalid("Error retrieving driver for provider %s" % default_provider)
 
-    def get_rules_by_physical_network(self, context, physical_network):
+        # physical_network -> ruleset as sent to the agents
+        self._ruleset_cache = {}
+        self.ruleset_cache_hits = 0
+        self.ruleset_cache_misses = 0
+        # physical_network -> (cached ruleset, its digest)
+        self._ruleset_digests = {}
+        self._subscribe_rule_changes()
+
+    def _subscribe_rule_changes(self):
+        # deleted networks take their rules along, which is a new generation
+        registry.subscribe(self._find_deleted_network, resources.NETWORK, events.BEFORE_DELETE)
+        registry.subscribe(self._delete_network_rules, resources.NETWORK, events.PRECOMMIT_DELETE)
+        registry.subscribe(self._send_deleted_network_rules, resources.NETWORK, events.AFTER_DELETE)
+        # subnets change the remote IPs of rules, which is a new generation
+        for event in (events.AFTER_CREATE, events.AFTER_UPDATE, events.AFTER_DELETE):
+            registry.subscribe(self._refresh_remote_network_rules, resources.SUBNET, event)
+
+    @staticmethod
+    def _get_deleted_networks(context):
+        """
+        Get the networks being deleted by the request of the context.
+
+        They are kept on the request context, network id -> a dict of the
+        physical network and the rules the delete takes along for the
+        agents, so nothing is left behind by a delete which fails.
+        """
+        deleted_networks = getattr(context, DELETED_NETWORKS_ATTR, None)
+        if deleted_networks is None:
+            deleted_networks = {}
+            setattr(context, DELETED_NETWORKS_ATTR, deleted_networks)
+        return deleted_networks
+
+    def _find_deleted_network(self, resource, event, trigger, **kwargs):
+        """
+        Look up the physical network of a network about to be deleted.
+
+        Its segments are deleted in the transaction deleting the network,
+        possibly before the rules are, so they are looked up beforehand.
+        """
+        context = kwargs['context']
+        network_id = kwargs['network_id']
+        self._get_deleted_networks(context)[network_id] = {
+            'physical_network': self._get_physical_network(context, network_id)}
+
+    def _delete_network_rules(self, resource, event, trigger, **kwargs):
+        """
+        Delete the rules of a network being deleted and the rules taking
+        their remote IPs from it.
+
+        Runs in the transaction deleting the network, so the physical
+        networks of the rules move to a new generation along with it.
+        """
+        context = kwargs['context']
+        network_id = kwargs['network_id']
+        deleted_network = self._get_deleted_networks(context).setdefault(network_id, {})
+        changes = []
+        with context.session.begin(subtransactions=True):
+            physical_network = deleted_network.get('physical_network')
+            if physical_network is None:
+                physical_network = self._get_physical_network(context, network_id)
+            rules_by_physical_network = self._get_rules_by_deleted_network(
+                context, network_id, physical_network)
+            # generations are locked in a fixed order, against deadlocks
+            for physical_network in sorted(rules_by_physical_network):
+                generation = self._bump_generation(context, physical_network)
+                agent_rules = []
+                for rule in rules_by_physical_network[physical_network]:
+                    # only the IDs of deleted rules matter to the agents
+                    agent_rules.append({'id': rule['id'], 'physical_network': physical_network,
+                                        'generation': generation})
+                    context.session.delete(rule)
+                changes.append(agent_rules)
+        deleted_network['changes'] = changes
+
+    def _send_deleted_network_rules(self, resource, event, trigger, **kwargs):
+        deleted_network = self._get_deleted_networks(kwargs['context']).pop(kwargs['network']['id'], {})
+        for agent_rules in deleted_network.get('changes', ()):
+            LOG.debug("Deleting %(count)d isoflat rules of network %(network)s along with "
+                      "network %(network_id)s",
+                      {'count': len(agent_rules), 'network': agent_rules[0]['physical_network'],
+                       'network_id': kwargs['network']['id']})
+            self.driver.delete_rule_bulk_postcommit(kwargs['context'], agent_rules)
+
+    def _refresh_remote_network_rules(self, resource, event, trigger, **kwargs):
+        """
+        Send the rules taking their remote IPs from a changed subnet's network.
+
+        Only the affected rules are sent, as a new generation of the rules
+        of each physical network they belong to.
+        """
+        context = kwargs['context']
+        subnet = kwargs['subnet']
+        original_subnet = kwargs.get('original_subnet')
+        if original_subnet is not None and original_subnet['cidr'] == subnet['cidr']:
+            return
+        updates = self._bump_remote_network_rules(context, subnet['network_id'])
+        for physical_network, generation, rules in updates:
+            LOG.debug("Refreshing %(count)d isoflat rules of network %(network)s on "
+                      "%(resource)s %(event)s", {'count': len(rules), 'network': physical_network,
+                                                 'resource': resource, 'event': event})
+            self.driver.update_rules_postcommit(context, physical_network, generation, rules)
+
+    @db_api.retry_if_session_inactive()
+    def _bump_remote_network_rules(self, context, network_id):
+        """
+        Move the rules taking their remote IPs from a network to a new generation.
+
+        :returns: a list of (physical network, generation, rules for the agents)
+        """
+        updates = []
+        with context.session.begin(subtransactions=True):
+            rules_by_physical_network = self._get_rules_by_remote_network(context, network_id)
+            if not rules_by_physical_network:
+                return updates
+            subnet_cidrs = self._get_subnet_cidrs_by_network(context, [network_id])
+            for physical_network in sorted(rules_by_physical_network):
+                rules = [self._prepare_rule_dict_for_agent(context, rule, physical_network, subnet_cidrs)
+                         for rule in rules_by_physical_network[physical_network]]
+                generation = self._bump_generation(context, physical_network)
+                updates.append((physical_network, generation, rules))
+        return updates
+
+    def _get_rules_for_agent(self, context, physical_network):
         rules = self._get_rules_by_physical_network(context, physical_network)
-        return [self._prepare_rule_dict_for_agent(context, rule, physical_network) for rule in rules]
+        # one query for the subnets of all remote networks, not one per rule
+        subnet_cidrs = self._get_subnet_cidrs_by_network(
+            context, set(rule['remote_network_id'] for rule in rules
+                         if rule['remote_ip'] is None and rule['remote_network_id'] is not None))
+        return [self._prepare_rule_dict_for_agent(context, rule, physical_network, subnet_cidrs)
+                for rule in rules]
 
-    def create_rule(self, context, rule):
-        LOG.debug("IsoflatPlugin.create_rule() called")
-        r = rule['rule']
-        network = self._get_network_details(context, r['network_id'])
-        physical_network = network['provider:physical_network']
-        self._check_network(context, network)
-        if r['remote_network_id'] is not None:
-            remote_network = self._get_network_details(context, r['network_id'])
-            self._check_network_type(remote_network)
+    def get_rules_by_physical_network(self, context, physical_network):
+        return self.get_ruleset_by_physical_network(context, physical_network)['rules']
 
+    def get_ruleset_by_physical_network(self, context, physical_network):
+        """
+        Get the rules of a physical network as sent to the agents.
+
+        Rulesets are cached per physical network. A cached ruleset is used
+        as long as the generation of the rules did not change.
+        """
         with context.session.begin(subtransactions=True):
-            r = super(IsoflatPlugin, self).create_rule(context, rule)
-            rule = self._prepare_rule_dict_for_agent(context, r, physical_network)
-            self.driver.create_rule_precommit(context, rule)
+            generation = self._get_generation(context, physical_network)
+            ruleset = self._ruleset_cache.get(physical_network)
+            if ruleset is not None and ruleset['generation'] == generation:
+                self.ruleset_cache_hits += 1
+                return ruleset
+            self.ruleset_cache_misses += 1
+            ruleset = {
+                'generation': generation,
+                'rules': self._get_rules_for_agent(context, physical_network)
+            }
+        LOG.debug("Built the isoflat ruleset of network %(network)s at generation "
+                  "%(generation)s (cache hits %(hits)d, misses %(misses)d)",
+                  {'network': physical_network, 'generation': generation,
+                   'hits': self.ruleset_cache_hits, 'misses': self.ruleset_cache_misses})
+        self._ruleset_cache[physical_network] = ruleset
+        return ruleset
+
+    def get_ruleset_digest_by_physical_network(self, context, physical_network):
+        """
+        Get the ruleset of a physical network along with the digest of its rules.
+
+        The digest is computed once per cached ruleset.
+        """
+        ruleset = self.get_ruleset_by_physical_network(context, physical_network)
+        cached = self._ruleset_digests.get(physical_network)
+        # a rebuilt ruleset is a new object, whatever its generation
+        if cached is not None and cached[0] is ruleset:
+            return ruleset, cached[1]
+        digest = utils.get_rules_digest(ruleset['rules'])
+        self._ruleset_digests[physical_network] = (ruleset, digest)
+        return ruleset, digest
+
+    def _check_rule_networks(self, context, rules):
+        """
+        Check the networks of the rules to create with a single lookup.
+
+        :returns: a dict of network id -> physical network
+        """
+        network_ids = set()
+        for r in rules:
+            network_ids.add(r['network_id'])
+            if r['remote_network_id'] is not None:
+                network_ids.add(r['remote_network_id'])
+        networks = self._get_networks_details(context, network_ids)
+        physical_networks = {}
+        for r in rules:
+            network = networks[r['network_id']]
+            self._check_network(context, network)
+            physical_networks[r['network_id']] = network['provider:physical_network']
+            if r['remote_network_id'] is not None:
+                self._check_network_type(networks[r['remote_network_id']])
+        return physical_networks
+
+    def _create_rules(self, context, rules):
+        physical_networks = self._check_rule_networks(context, [rule['rule'] for rule in rules])
+        # physical_network -> (generation, rules for the agents)
+        changes = {}
+        with context.session.begin(subtransactions=True):
+            created = [super(IsoflatPlugin, self).create_rule(context, rule) for rule in rules]
+            subnet_cidrs = self._get_subnet_cidrs_by_network(
+                context, set(r['remote_network_id'] for r in created
+                             if r['remote_ip'] is None and r['remote_network_id'] is not None))
+            # the generation rows are locked in the same order by all the
+            # transactions, so that concurrent ones do not deadlock
+            for physical_network in sorted(set(physical_networks[r['network_id']] for r in created)):
+                changes[physical_network] = (self._bump_generation(context, physical_network), [])
+            for r in created:
+                physical_network = physical_networks[r['network_id']]
+                generation, agent_rules = changes[physical_network]
+                agent_rule = self._prepare_rule_dict_for_agent(context, r, physical_network, subnet_cidrs)
+                agent_rule['generation'] = generation
+                self.driver.create_rule_precommit(context, agent_rule)
+                agent_rules.append(agent_rule)
         try:
-            self.driver.create_rule_postcommit(context, rule)
+            for generation, agent_rules in changes.values():
+                if len(agent_rules) == 1:
+                    self.driver.create_rule_postcommit(context, agent_rules[0])
+                else:
+                    self.driver.create_rule_bulk_postcommit(context, agent_rules)
         except Exception:
             with excutils.save_and_reraise_exception():
-                LOG.error("Failed to create isoflat rule on driver,"
-                          "deleting rule %s", r['id'])
-                super(IsoflatPlugin, self).delete_rule(context, r['id'])
-        return r
+                LOG.error("Failed to create isoflat rules on driver, "
+                          "deleting rules %s", ', '.join(r['id'] for r in created))
+                with context.session.begin(subtransactions=True):
+                    for r in created:
+                        super(IsoflatPlugin, self).delete_rule(context, r['id'])
+                    # the rules were part of a generation, so is their removal
+                    for physical_network in sorted(changes):
+                        self._bump_generation(context, physical_network)
+        return created
+
+    @db_api.retry_if_session_inactive()
+    def create_rule(self, context, rule):
+        LOG.debug("IsoflatPlugin.create_rule() called")
+        return self._create_rules(context, [rule])[0]
 
+    @db_api.retry_if_session_inactive()
+    def create_rule_bulk(self, context, rules):
+        """
+        Create many isoflat rules in a single transaction.
+
+        The networks of all the rules are looked up at once and each
+        physical network gets a single update for all its new rules.
+        """
+        LOG.debug("IsoflatPlugin.create_rule_bulk() called")
+        return self._create_rules(context, rules['rules'])
+
+    @db_api.retry_if_session_inactive()
     def delete_rule(self, context, rule_id):
         LOG.debug("IsoflatPlugin.delete_rule() called")
         with context.session.begin(subtransactions=True):
@@ -95,6 +343,7 @@ class IsoflatPlugin(isoflat_db.IsoflatDbMixin):
             super(IsoflatPlugin, self).delete_rule(context, rule_id)
 
             rule = self._prepare_rule_dict_for_agent(context, r, physical_network)
+            rule['generation'] = self._bump_generation(context, physical_network)
             self.driver.delete_rule_precommit(context, rule)
         try:
             self.driver.delete_rule_postcommit(context, rule)
@@ -102,3 +351,66 @@ class IsoflatPlugin(isoflat_db.IsoflatDbMixin):
             with excutils.save_and_reraise_exception():
                 LOG.error("Failed to delete rule on driver. "
                           "rule: %s", rule_id)
+
+    @db_api.retry_if_session_inactive()
+    def create_rule_deletion(self, context, rule_deletion):
+        """
+        Delete the rules of a network, or the rules with the given IDs.
+
+        All the rules go in a single transaction and each physical network
+        gets a single update for all its deleted rules.
+        """
+        LOG.debug("IsoflatPlugin.create_rule_deletion() called")
+        d = rule_deletion['rule_deletion']
+        if d['network_id'] is None and not d['rule_ids']:
+            raise isoflat.NoRulesToDelete()
+        # physical_network -> (generation, deleted rules for the agents)
+        changes = {}
+        with context.session.begin(subtransactions=True):
+            rules = self._get_rules_to_delete(context, d['network_id'], d['rule_ids'])
+            rule_network_ids = set(rule['network_id'] for rule in rules)
+            network_ids = set(rule_network_ids)
+            if d['network_id'] is not None:
+                # the network is checked even when it has no rules
+                network_ids.add(d['network_id'])
+            networks = self._get_networks_details(context, network_ids)
+            for network in networks.values():
+                self._check_network(context, network)
+            rule_ids = [rule['id'] for rule in rules]
+            # the generation rows are locked in the same order by all the
+            # transactions, so that concurrent ones do not deadlock
+            physical_networks = set(networks[network_id]['provider:physical_network']
+                                    for network_id in rule_network_ids)
+            for physical_network in sorted(physical_networks):
+                changes[physical_network] = (self._bump_generation(context, physical_network), [])
+            for rule in rules:
+                physical_network = networks[rule['network_id']]['provider:physical_network']
+                generation, agent_rules = changes[physical_network]
+                # only the IDs of deleted rules matter to the agents
+                agent_rule = {'id': rule['id'], 'physical_network': physical_network,
+                              'generation': generation}
+                context.session.delete(rule)
+                self.driver.delete_rule_precommit(context, agent_rule)
+                agent_rules.append(agent_rule)
+        try:
+            for generation, agent_rules in changes.values():
+                self.driver.delete_rule_bulk_postcommit(context, agent_rules)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                LOG.error("Failed to delete rules on driver. "
+                          "rules: %s", ', '.join(rule_ids))
+        # rule deletions are not kept, so there is no id to return
+        return {
+            'tenant_id': context.tenant_id,
+            'network_id': d['network_id'],
+            'rule_ids': rule_ids,
+        }
+
+    def get_rule_deletions(self, context, filters=None, fields=None,
+                           sorts=None, limit=None, marker=None,
+                           page_reverse=False):
+        # rule deletions are carried out right away and not kept
+        return []
+
+    def get_rule_deletion(self, context, rule_deletion_id, fields=None):
+        raise isoflat.IsoflatRuleDeletionNotFound(rule_deletion_id=rule_deletion_id)
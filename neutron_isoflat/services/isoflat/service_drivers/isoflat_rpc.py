@@ -1,13 +1,48 @@
+import collections
+
 import oslo_messaging as messaging
 from neutron.common import rpc as n_rpc
+from neutron.notifiers import batch_notifier
+from neutron_lib import context as n_context
+from oslo_config import cfg
 from oslo_log import log as logging
 
+from neutron_isoflat._i18n import _
 from neutron_isoflat.common import constants
+from neutron_isoflat.common import topics
 
 LOG = logging.getLogger(__name__)
 
+OPTS = [
+    cfg.FloatOpt('rule_update_batch_interval',
+                 default=0.5,
+                 help=_("Seconds the isoflat rule changes of a physical network are "
+                        "collected for before they are sent to the agents as a single "
+                        "update. Set to 0 to send every change right away.")),
+    cfg.BoolOpt('notify_legacy_agents',
+                default=False,
+                help=_("Transitional option for rolling upgrades. Also cast "
+                       "the full rules of a changed physical network to every "
+                       "agent on the common agent topic, the way servers did "
+                       "before rule deltas, for agents not upgraded yet. This "
+                       "costs a full ruleset per update to every agent, so "
+                       "only enable it while such agents remain.")),
+]
+cfg.CONF.register_opts(OPTS, constants.ISOFLAT)
+
 
 class IsoflatRpcDriver(object):
+    """
+    RPC API version history:
+        1.0 - Initial version.
+        1.1 - Agents get rule changes through update_rules_delta and fetch
+              the rules with their generation through get_ruleset_for_network.
+        1.2 - update_rules_delta may span several generations.
+        1.3 - Added get_rulesets_for_networks.
+        1.4 - Added check_rulesets_for_networks.
+    """
+
+    target = messaging.Target(version='1.4')
 
     def __init__(self, service_plugin):
         LOG.debug("Loading IsoflatRpcDriver.")
@@ -18,29 +53,139 @@ class IsoflatRpcDriver(object):
         self.conn.consume_in_threads()
         target = messaging.Target(topic=constants.TOPIC_ISOFLAT_AGENT, version='1.0')
         self.client = n_rpc.get_client(target)
+        self._batch_notifier = None
+        if cfg.CONF.ISOFLAT.rule_update_batch_interval > 0:
+            self._batch_notifier = batch_notifier.BatchNotifier(
+                cfg.CONF.ISOFLAT.rule_update_batch_interval, self._send_rule_changes)
 
     @property
     def service_type(self):
         pass
 
-    def _update_rules_rpc(self, context, rule):
-        physical_network = rule['physical_network']
+    def _cast_rule_delta(self, context, delta):
+        physical_network = delta['physical_network']
+        LOG.debug("Sending the RPC call for updating isoflat rules on network %s "
+                  "from generation %s to %s", physical_network,
+                  delta['base_generation'], delta['generation'])
+        # only the agents with a bridge mapping for the physical network
+        # consume its topic
+        cctxt = self.client.prepare(topic=topics.get_agent_topic(physical_network), fanout=True,
+                                    version='1.2')
+        cctxt.cast(context, 'update_rules_delta', physical_network=physical_network,
+                   base_generation=delta['base_generation'], generation=delta['generation'],
+                   added_rules=list(delta['added_rules'].values()),
+                   removed_rule_ids=sorted(delta['removed_rule_ids']))
+
+    def _cast_legacy_rules(self, context, physical_network):
+        # agents which are not upgraded yet consume the common topic only,
+        # and only know update_rules 1.0
         rules = self.service_plugin.get_rules_by_physical_network(context, physical_network)
-        LOG.debug("Sending the RPC call for updating isoflat rules on network %s" % physical_network)
         cctxt = self.client.prepare(fanout=True)
         cctxt.cast(context, 'update_rules', physical_network=physical_network, isoflat_rules=rules)
 
+    def _send_rule_changes(self, changes):
+        """
+        Send the rule changes of a batch, one update per physical network.
+
+        Changes are merged in the order of their generations. Where another
+        server made the change of a generation in between, the changes are
+        sent as separate updates so agents notice the gap.
+        """
+        context = n_context.get_admin_context()
+        changes_by_network = collections.OrderedDict()
+        for change in changes:
+            changes_by_network.setdefault(change['physical_network'], []).append(change)
+        for physical_network, network_changes in changes_by_network.items():
+            delta = None
+            for change in sorted(network_changes, key=lambda change: change['generation']):
+                if delta is not None and change['generation'] != delta['generation'] + 1:
+                    self._cast_rule_delta(context, delta)
+                    delta = None
+                if delta is None:
+                    delta = {'physical_network': physical_network,
+                             'base_generation': change['generation'] - 1,
+                             'added_rules': collections.OrderedDict(),
+                             'removed_rule_ids': set()}
+                for rule_id in change['removed_rule_ids']:
+                    # agents never saw a rule added in the same update
+                    if delta['added_rules'].pop(rule_id, None) is None:
+                        delta['removed_rule_ids'].add(rule_id)
+                for rule in change['added_rules']:
+                    delta['added_rules'][rule['id']] = rule
+                delta['generation'] = change['generation']
+            self._cast_rule_delta(context, delta)
+            if cfg.CONF.ISOFLAT.notify_legacy_agents:
+                self._cast_legacy_rules(context, physical_network)
+
+    def _update_rules_rpc(self, context, physical_network, generation, added_rules=(), removed_rule_ids=()):
+        change = {'physical_network': physical_network,
+                  'generation': generation,
+                  'added_rules': list(added_rules),
+                  'removed_rule_ids': list(removed_rule_ids)}
+        if self._batch_notifier is None:
+            self._send_rule_changes([change])
+        else:
+            self._batch_notifier.queue_event(change)
+
+    @staticmethod
+    def _agent_rule(rule):
+        return dict((key, value) for key, value in rule.items() if key != 'generation')
+
     def create_rule_precommit(self, context, rule):
         pass
 
     def create_rule_postcommit(self, context, rule):
-        self._update_rules_rpc(context, rule)
+        self._update_rules_rpc(context, rule['physical_network'], rule['generation'],
+                               added_rules=[self._agent_rule(rule)])
+
+    def create_rule_bulk_postcommit(self, context, rules):
+        # all the rules of a bulk create share their physical network and generation
+        self._update_rules_rpc(context, rules[0]['physical_network'], rules[0]['generation'],
+                               added_rules=[self._agent_rule(rule) for rule in rules])
 
     def delete_rule_precommit(self, context, rule):
         pass
 
     def delete_rule_postcommit(self, context, rule):
-        self._update_rules_rpc(context, rule)
+        self._update_rules_rpc(context, rule['physical_network'], rule['generation'],
+                               removed_rule_ids=[rule['id']])
+
+    def delete_rule_bulk_postcommit(self, context, rules):
+        # all the rules of a bulk delete share their physical network and generation
+        self._update_rules_rpc(context, rules[0]['physical_network'], rules[0]['generation'],
+                               removed_rule_ids=[rule['id'] for rule in rules])
+
+    def update_rules_postcommit(self, context, physical_network, generation, rules):
+        # agents replace rules removed and added in the same update
+        self._update_rules_rpc(context, physical_network, generation, added_rules=rules,
+                               removed_rule_ids=[rule['id'] for rule in rules])
 
     def get_rules_for_network(self, context, physical_network):
         return self.service_plugin.get_rules_by_physical_network(context, physical_network)
+
+    def get_ruleset_for_network(self, context, physical_network):
+        return self.service_plugin.get_ruleset_by_physical_network(context, physical_network)
+
+    def get_rulesets_for_networks(self, context, physical_networks):
+        return dict((physical_network,
+                     self.service_plugin.get_ruleset_by_physical_network(context, physical_network))
+                    for physical_network in physical_networks)
+
+    def check_rulesets_for_networks(self, context, digests):
+        """
+        Compare the digests of the rules agents applied with the server's.
+
+        :param digests: a dict of physical network -> digest of the rules
+            the agent applied, None when it applied none
+        :returns: the rulesets of the physical networks whose digest differs
+        """
+        rulesets = {}
+        for physical_network, digest in digests.items():
+            ruleset, server_digest = self.service_plugin.get_ruleset_digest_by_physical_network(
+                context, physical_network)
+            if digest != server_digest:
+                LOG.info("Isoflat rules an agent applied on network %s differ from the "
+                         "server's, sending the rules of generation %s",
+                         physical_network, ruleset['generation'])
+                rulesets[physical_network] = ruleset
+        return rulesets
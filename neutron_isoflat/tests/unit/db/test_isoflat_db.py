@@ -0,0 +1,158 @@
+import itertools
+
+import mock
+from neutron.db.models.segment import NetworkSegment
+from neutron.db.models_v2 import Network, Subnet
+from neutron.tests.unit import testlib_api
+from neutron_lib import context
+from oslo_utils import uuidutils
+import sqlalchemy as sa
+
+from neutron_isoflat.db.models.isoflat import IsoflatRule
+from neutron_isoflat.services.isoflat import isoflat_plugin
+
+PHYSICAL_NETWORK = 'physnet1'
+PROJECT_ID = 'test-project'
+
+
+class IsoflatDbTestCaseBase(testlib_api.SqlTestCase):
+
+    def setUp(self):
+        super(IsoflatDbTestCaseBase, self).setUp()
+        self.ctx = context.get_admin_context()
+        with mock.patch.object(isoflat_plugin.st_db, 'ServiceTypeManager'), \
+                mock.patch.object(isoflat_plugin.service_base, 'load_drivers',
+                                  return_value=({'isoflat': mock.Mock()}, 'isoflat')), \
+                mock.patch.object(isoflat_plugin.registry, 'subscribe'):
+            self.plugin = isoflat_plugin.IsoflatPlugin()
+        self._vxlan_ids = itertools.count(1000)
+
+    def _add_network(self, physical_network=None, cidrs=()):
+        """
+        Add the flat network of a physical network, which can only have
+        one, or a VXLAN network when no physical network is given.
+        """
+        network_id = uuidutils.generate_uuid()
+        if physical_network is None:
+            segment = {'network_type': 'vxlan', 'segmentation_id': next(self._vxlan_ids)}
+        else:
+            segment = {'network_type': 'flat', 'physical_network': physical_network}
+        with self.ctx.session.begin(subtransactions=True):
+            self.ctx.session.add(Network(id=network_id, project_id=PROJECT_ID, name=network_id,
+                                         status='ACTIVE', admin_state_up=True))
+            self.ctx.session.add(NetworkSegment(id=uuidutils.generate_uuid(), network_id=network_id,
+                                                segment_index=0, is_dynamic=False, **segment))
+            for cidr in cidrs:
+                self.ctx.session.add(Subnet(id=uuidutils.generate_uuid(), project_id=PROJECT_ID,
+                                            network_id=network_id, ip_version=4, cidr=cidr,
+                                            enable_dhcp=False))
+        return network_id
+
+
+class IsoflatRulesForAgentTestCase(IsoflatDbTestCaseBase):
+
+    def _add_rules(self, count):
+        """
+        Add count rules to the flat network of the physical network, a third
+        of them with a remote IP, a third with a remote network and the rest
+        matching any address.
+        """
+        network = self._add_network(PHYSICAL_NETWORK)
+        remote_networks = [self._add_network(cidrs=['10.%d.0.0/24' % i, '10.%d.1.0/24' % i])
+                           for i in range(50)]
+        # rules of another physical network are not sent
+        other_network = self._add_network('physnet2')
+        expected = {}
+        with self.ctx.session.begin(subtransactions=True):
+            for i in range(count):
+                rule = {'id': uuidutils.generate_uuid(), 'remote_ip': None,
+                        'remote_network_id': None}
+                if i % 3 == 0:
+                    rule['remote_ip'] = '192.168.%d.%d/32' % (i // 256, i % 256)
+                    expected[rule['id']] = [rule['remote_ip']]
+                elif i % 3 == 1:
+                    remote_network = i % len(remote_networks)
+                    rule['remote_network_id'] = remote_networks[remote_network]
+                    expected[rule['id']] = ['10.%d.0.0/24' % remote_network,
+                                            '10.%d.1.0/24' % remote_network]
+                else:
+                    expected[rule['id']] = ['0.0.0.0/0']
+                self.ctx.session.add(IsoflatRule(project_id=PROJECT_ID,
+                                                 network_id=network,
+                                                 direction='ingress', ethertype='IPv4', **rule))
+            self.ctx.session.add(IsoflatRule(id=uuidutils.generate_uuid(), project_id=PROJECT_ID,
+                                             network_id=other_network, direction='ingress',
+                                             ethertype='IPv4'))
+        return expected
+
+    def _count_statements(self, func, *args):
+        statements = []
+
+        def _before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = self.ctx.session.get_bind()
+        sa.event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        try:
+            result = func(*args)
+        finally:
+            sa.event.remove(engine, 'before_cursor_execute', _before_cursor_execute)
+        return result, statements
+
+    def test_rules_for_agent_take_constant_statements(self):
+        expected = self._add_rules(1000)
+        rules, statements = self._count_statements(self.plugin._get_rules_for_agent,
+                                                   self.ctx, PHYSICAL_NETWORK)
+        # one query for the rules and one for the subnets of the remote networks
+        self.assertEqual(2, len(statements), statements)
+        self.assertEqual(expected, dict((rule['id'], sorted(rule['remote_ips'])) for rule in rules))
+        self.assertEqual(set([PHYSICAL_NETWORK]), set(rule['physical_network'] for rule in rules))
+
+    def test_cached_ruleset_takes_a_single_statement(self):
+        self._add_rules(1000)
+        ruleset = self.plugin.get_ruleset_by_physical_network(self.ctx, PHYSICAL_NETWORK)
+        cached, statements = self._count_statements(self.plugin.get_ruleset_by_physical_network,
+                                                    self.ctx, PHYSICAL_NETWORK)
+        # only the generation is read
+        self.assertEqual(1, len(statements), statements)
+        self.assertIs(ruleset, cached)
+        self.assertEqual(1000, len(cached['rules']))
+
+
+class IsoflatNetworkDeleteTestCase(IsoflatDbTestCaseBase):
+
+    def _add_rule(self, network_id, remote_network_id=None):
+        rule = IsoflatRule(id=uuidutils.generate_uuid(), project_id=PROJECT_ID,
+                           network_id=network_id, direction='ingress', ethertype='IPv4',
+                           remote_network_id=remote_network_id)
+        with self.ctx.session.begin(subtransactions=True):
+            self.ctx.session.add(rule)
+        return rule['id']
+
+    def test_delete_network_after_its_segments(self):
+        network_id = self._add_network(PHYSICAL_NETWORK, cidrs=['10.0.0.0/24'])
+        other_network_id = self._add_network('physnet2')
+        own_rule_ids = set([self._add_rule(network_id), self._add_rule(network_id, network_id)])
+        remote_rule_id = self._add_rule(other_network_id, network_id)
+        kept_rule_id = self._add_rule(other_network_id)
+        generation = self.plugin._get_generation(self.ctx, PHYSICAL_NETWORK)
+        other_generation = self.plugin._get_generation(self.ctx, 'physnet2')
+
+        self.plugin._find_deleted_network('network', 'before_delete', None,
+                                          context=self.ctx, network_id=network_id)
+        with self.ctx.session.begin(subtransactions=True):
+            # neutron deletes the segments of the network first
+            self.ctx.session.query(NetworkSegment).filter_by(network_id=network_id).delete()
+            self.plugin._delete_network_rules('network', 'precommit_delete', None,
+                                              context=self.ctx, network_id=network_id)
+        self.plugin._send_deleted_network_rules('network', 'after_delete', None,
+                                                context=self.ctx, network={'id': network_id})
+
+        self.assertEqual(generation + 1, self.plugin._get_generation(self.ctx, PHYSICAL_NETWORK))
+        self.assertEqual(other_generation + 1, self.plugin._get_generation(self.ctx, 'physnet2'))
+        sent = dict((agent_rules[0]['physical_network'], agent_rules) for agent_rules in
+                    (call[0][1] for call in self.plugin.driver.delete_rule_bulk_postcommit.call_args_list))
+        self.assertEqual(own_rule_ids, set(rule['id'] for rule in sent[PHYSICAL_NETWORK]))
+        self.assertEqual([remote_rule_id], [rule['id'] for rule in sent['physnet2']])
+        self.assertEqual([kept_rule_id], [rule.id for rule in self.ctx.session.query(IsoflatRule)])
+        self.assertEqual({}, self.plugin._get_deleted_networks(self.ctx))
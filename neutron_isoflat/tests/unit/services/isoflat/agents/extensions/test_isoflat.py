@@ -0,0 +1,79 @@
+import mock
+from neutron.tests import base
+
+from neutron_isoflat.services.isoflat.agents.extensions import isoflat
+
+PHYSICAL_NETWORK = 'physnet1'
+
+
+def _rule(rule_id):
+    return {'id': rule_id, 'physical_network': PHYSICAL_NETWORK, 'remote_ips': ['0.0.0.0/0']}
+
+
+class IsoflatAgentExtensionUpdatesTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(IsoflatAgentExtensionUpdatesTestCase, self).setUp()
+        self.extension = isoflat.IsoflatAgentExtension()
+        self.extension.physical_networks = frozenset([PHYSICAL_NETWORK])
+        self.extension.driver = mock.MagicMock()
+        mock.patch.object(self.extension, '_save_rules_state').start()
+        # the rules of generation 5 are applied
+        self.extension._generations[PHYSICAL_NETWORK] = 5
+        self.extension._rules[PHYSICAL_NETWORK] = {'a': _rule('a')}
+        self.extension._applied_rulesets[PHYSICAL_NETWORK] = {'generation': 5,
+                                                              'rules': [_rule('a')]}
+
+    def _take_updates(self):
+        updates = self.extension._pending_updates
+        self.extension._pending_updates = isoflat.collections.OrderedDict()
+        return updates
+
+    def _applied_rule_ids(self):
+        return [sorted(rule['id'] for rule in call[0][2])
+                for call in self.extension.driver.update_rules.call_args_list]
+
+    def test_delta_out_of_order_keeps_pending_sync(self):
+        self.extension.update_rules_delta(None, PHYSICAL_NETWORK, 7, [_rule('c')], [],
+                                          base_generation=6)
+        self.assertIs(isoflat.SYNC_RULES, self.extension._pending_updates[PHYSICAL_NETWORK])
+        # the missing generation arriving late does not replace the fetch
+        self.extension.update_rules_delta(None, PHYSICAL_NETWORK, 6, [_rule('b')], [],
+                                          base_generation=5)
+        self.assertIs(isoflat.SYNC_RULES, self.extension._pending_updates[PHYSICAL_NETWORK])
+        self.assertEqual(6, self.extension._generations[PHYSICAL_NETWORK])
+
+        get_rulesets = mock.patch.object(self.extension, 'get_rulesets_for_networks').start()
+        get_rulesets.return_value = {PHYSICAL_NETWORK: {'generation': 7,
+                                                        'rules': [_rule('a'), _rule('b'), _rule('c')]}}
+        self.extension._apply_updates(self._take_updates())
+        self.assertEqual([['a', 'b', 'c']], self._applied_rule_ids())
+        self.assertEqual(7, self.extension._generations[PHYSICAL_NETWORK])
+
+    def test_stale_ruleset_queued_during_fetch_is_dropped(self):
+        self.extension.update_rules_delta(None, PHYSICAL_NETWORK, 7, [_rule('c')], [],
+                                          base_generation=6)
+
+        def _get_rulesets(physical_networks):
+            # the missing generation arrives while the rules are fetched
+            self.extension.update_rules_delta(None, PHYSICAL_NETWORK, 6, [_rule('b')], [],
+                                              base_generation=5)
+            return {PHYSICAL_NETWORK: {'generation': 7,
+                                       'rules': [_rule('a'), _rule('b'), _rule('c')]}}
+
+        mock.patch.object(self.extension, 'get_rulesets_for_networks',
+                          side_effect=_get_rulesets).start()
+        self.extension._apply_updates(self._take_updates())
+        stale = self._take_updates()
+        self.assertEqual(6, stale[PHYSICAL_NETWORK]['generation'])
+        self.extension._apply_updates(stale)
+        self.assertEqual([['a', 'b', 'c']], self._applied_rule_ids())
+        self.assertEqual(7, self.extension._applied_rulesets[PHYSICAL_NETWORK]['generation'])
+        self.assertEqual(7, self.extension._generations[PHYSICAL_NETWORK])
+
+    def test_differing_rules_of_the_same_generation_are_applied(self):
+        mock.patch.object(self.extension, 'check_rulesets_for_networks', return_value={
+            PHYSICAL_NETWORK: {'generation': 5, 'rules': [_rule('a'), _rule('b')]}}).start()
+        self.extension._check_rules()
+        self.extension._apply_updates(self._take_updates())
+        self.assertEqual([['a', 'b']], self._applied_rule_ids())
@@ -0,0 +1,194 @@
+import random
+
+import mock
+from neutron.tests import base
+
+from neutron_isoflat.services.isoflat.agents.firewall.linux import ebtables_manager
+
+BINARY_NAME = 'isoflat-test'
+
+
+def _legacy_modify_rules(manager, current_lines, table):
+    """
+    EbtablesManager._modify_rules as it was before the indexed rewrite.
+
+    Except for chains slated for removal being matched by their name, as
+    ebtables-save lists them along with their policy.
+    """
+    unwrapped_chains = sorted(table.unwrapped_chains)
+    chains = sorted(table.chains)
+    rules = set(map(str, table.rules))
+
+    new_filter = [line.strip() for line in current_lines
+                  if manager.wrap_name not in line and
+                  line.strip() not in rules]
+
+    our_chains = [':%s-%s' % (manager.wrap_name, name) for name in chains]
+    our_chains += [':%s' % name for name in unwrapped_chains
+                   if not any(':%s' % name in s for s in new_filter)]
+
+    our_top_rules = []
+    our_bottom_rules = []
+    for rule in table.rules:
+        rule_str = str(rule)
+        if rule.top:
+            our_top_rules += [rule_str]
+        else:
+            our_bottom_rules += [rule_str]
+
+    our_chains_and_rules = our_chains + our_top_rules + our_bottom_rules
+
+    rules_index = manager._find_rules_index(new_filter)
+    new_filter[rules_index:rules_index] = our_chains_and_rules
+
+    remove_chains = set(table.remove_chains)
+    remove_rules = list(table.remove_rules)
+
+    def _weed_out_removes(line):
+        if line.startswith(':'):
+            chain = line[1:].split(' ', 1)[0]
+            if chain in remove_chains:
+                remove_chains.remove(chain)
+                return False
+        else:
+            if line in remove_rules:
+                remove_rules.remove(line)
+                return False
+        return True
+
+    seen_lines = set()
+
+    def _weed_out_duplicates(line):
+        if line in seen_lines:
+            return False
+        seen_lines.add(line)
+        return True
+
+    new_filter.reverse()
+    new_filter = [line for line in new_filter
+                  if _weed_out_duplicates(line) and
+                  _weed_out_removes(line)]
+    new_filter.reverse()
+    return new_filter
+
+
+def _generate_table(seed, size):
+    """
+    Build a manager with a filter table of about size rules and the lines
+    ebtables-save could show for it.
+
+    The saved lines hold foreign chains and rules, stale rules of our own,
+    duplicates and rules and chains slated for removal. Chain names are
+    zero padded, so no name is the prefix of another one.
+    """
+    rand = random.Random(seed)
+    manager = ebtables_manager.EbtablesManager(_execute=lambda *args, **kwargs: '',
+                                               state_less=True, _binary_name=BINARY_NAME)
+    table = manager.tables['filter']
+    wrap_name = manager.wrap_name
+
+    chains = ['chain-%04d' % i for i in range(max(1, size // 50))]
+    for chain in chains:
+        table.add_chain(chain)
+    unwrapped = ['isoflat-top-%04d' % i for i in range(rand.randint(1, 5))]
+    for chain in unwrapped:
+        table.add_chain(chain, wrap=False)
+        table.add_rule('FORWARD', '-j %s' % chain, wrap=False)
+    for i in range(size):
+        table.add_rule(rand.choice(chains), '-s 10.%d.%d.0/24 -j DROP' % (i // 256 % 256, i % 256),
+                       top=rand.random() < 0.1)
+        if rand.random() < 0.02:
+            # duplicates are swept
+            table.add_rule(rand.choice(chains), '-p IPv4 -j DROP')
+
+    current_lines = ['*filter', ':INPUT ACCEPT', ':FORWARD ACCEPT', ':OUTPUT ACCEPT']
+    foreign_chains = ['foreign-%04d' % i for i in range(rand.randint(0, size // 10 + 1))]
+    current_lines += [':%s RETURN' % chain for chain in foreign_chains]
+    # some unwrapped chains exist already
+    current_lines += [':%s RETURN' % chain for chain in unwrapped if rand.random() < 0.5]
+    current_lines += [':%s-%s RETURN' % (wrap_name, chain) for chain in chains[:3]]
+    for i in range(size // 5):
+        if foreign_chains:
+            current_lines.append('-A %s -d 192.168.%d.%d -j DROP' % (
+                rand.choice(foreign_chains), i // 256 % 256, i % 256))
+        current_lines.append('-A %s-%s -s 172.16.%d.0/24 -j DROP' % (wrap_name, rand.choice(chains),
+                                                                     i % 256))
+    current_lines += ['-A FORWARD -j %s' % chain for chain in unwrapped[:2]]
+    current_lines += ['-A FORWARD -j %s' % chain for chain in unwrapped[:1]]
+
+    # a removed unwrapped chain and the rules jumping to it
+    if len(unwrapped) > 1:
+        table.remove_chain(unwrapped[-1], wrap=False)
+        current_lines += [':%s RETURN' % unwrapped[-1], '-A FORWARD -j %s' % unwrapped[-1]]
+    return manager, table, current_lines
+
+
+class EbtablesManagerModifyRulesTestCase(base.BaseTestCase):
+
+    def _assert_same_as_legacy(self, seed, size):
+        manager, table, current_lines = _generate_table(seed, size)
+        legacy_manager, legacy_table, _lines = _generate_table(seed, size)
+        expected = _legacy_modify_rules(legacy_manager, current_lines, legacy_table)
+        self.assertEqual(expected, manager._modify_rules(current_lines, table))
+
+    def test_modify_rules_matches_legacy_small_tables(self):
+        for seed in range(40):
+            self._assert_same_as_legacy(seed, random.Random(seed).randint(0, 500))
+
+    def test_modify_rules_matches_legacy_large_tables(self):
+        for seed, size in ((100, 5000), (101, 10000), (102, 20000)):
+            self._assert_same_as_legacy(seed, size)
+
+    def test_modify_rules_drops_removed_chains_and_rules(self):
+        manager, table, current_lines = _generate_table(7, 200)
+        removed_chains = set(table.remove_chains)
+        removed_rules = set(table.remove_rules)
+        self.assertTrue(removed_chains)
+        self.assertTrue(removed_rules)
+        # the saved lines hold the removed chain and a jump to it
+        self.assertTrue(set(':%s RETURN' % chain for chain in removed_chains) & set(current_lines))
+        self.assertTrue(removed_rules & set(current_lines))
+        new_lines = manager._modify_rules(current_lines, table)
+        self.assertFalse(removed_rules & set(new_lines))
+        chains = set(line[1:].split(' ', 1)[0] for line in new_lines if line.startswith(':'))
+        self.assertFalse(removed_chains & chains)
+        self.assertEqual(len(new_lines), len(set(new_lines)))
+
+
+class EbtablesManagerConvergenceTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(EbtablesManagerConvergenceTestCase, self).setUp()
+        self.manager = ebtables_manager.EbtablesManager(_execute=lambda *args, **kwargs: '',
+                                                        state_less=True, _binary_name=BINARY_NAME)
+        table = self.manager.tables['filter']
+        table.add_chain('isoflat-top', wrap=False)
+        table.add_rule('FORWARD', '-j isoflat-top', wrap=False)
+        table.add_chain('chain')
+        table.add_rule('chain', '-j DROP')
+        wrap_name = self.manager.wrap_name
+        self.applied = ['*filter', ':INPUT ACCEPT', ':FORWARD ACCEPT', ':OUTPUT ACCEPT',
+                        ':neutron-nwfilter RETURN', ':isoflat-top RETURN',
+                        ':%s-chain RETURN' % wrap_name,
+                        '-A FORWARD -j neutron-nwfilter', '-A FORWARD -j isoflat-top',
+                        '-A %s-chain -j DROP' % wrap_name]
+        self.manager._applied_tables = {'filter': self.applied}
+        self.apply_changes = mock.patch.object(self.manager, '_apply_changes').start()
+
+    def _check_convergence(self, saved):
+        with mock.patch.object(self.manager, '_save_tables', return_value={'filter': saved}):
+            self.manager._check_convergence()
+
+    def test_foreign_changes_are_not_divergences(self):
+        saved = [line for line in self.applied if 'neutron-nwfilter' not in line]
+        saved += [':nova-filter RETURN', '-A FORWARD -j nova-filter']
+        self._check_convergence(saved)
+        self.assertEqual(0, self.manager.convergence_divergences)
+        self.assertFalse(self.apply_changes.called)
+        self.assertEqual({'filter': saved}, self.manager._applied_tables)
+
+    def test_our_changes_are_applied_again(self):
+        saved = [line for line in self.applied if not line.endswith('-chain -j DROP')]
+        self._check_convergence(saved)
+        self.assertEqual(1, self.manager.convergence_divergences)
+        self.apply_changes.assert_called_once_with()
@@ -0,0 +1,215 @@
+"""Benchmark of the ebtables rule handling of the isoflat agent.
+
+Run it with ``tox -e benchmark`` or, in an environment with neutron
+installed, ``python tools/benchmark_ebtables.py``. Every time printed is
+the best of --repeat runs, in seconds.
+"""
+from __future__ import print_function
+
+import argparse
+import difflib
+import random
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2.7
+    tracemalloc = None
+
+from neutron_isoflat.services.isoflat.agents.firewall.linux import ebtables_manager
+
+CHAIN = 'neutron-isoflat-INPUT'
+
+
+def _rule_lines(count, prefix='10'):
+    return ['-A %s -p IPv4 --ip-src %s.%d.%d.%d/32 -j DROP' % (
+        CHAIN, prefix, i // 65536, i // 256 % 256, i % 256) for i in range(count)]
+
+
+def _ndiff_commands(chain, old_chain_rules, new_chain_rules):
+    """The difflib.ndiff based chain diff the agent used before."""
+    old_index = 1
+    statements = []
+    for line in difflib.ndiff(old_chain_rules, new_chain_rules):
+        if line.startswith('?'):
+            continue
+        elif line.startswith('-'):
+            statements.append('-D %s %d' % (chain, old_index))
+            old_index -= 1
+        elif line.startswith('+'):
+            rule = line[5:].split(' ', 1)[-1]
+            if rule == chain:
+                rule = ''
+            statements.append('-I %s %d %s' % (chain, old_index, rule))
+        old_index += 1
+    return statements
+
+
+class _PlainRule(object):
+    """The EbtablesRule the agent used before, rendering its line on str()."""
+
+    def __init__(self, chain, rule, wrap=True, top=False,
+                 _binary_name=ebtables_manager.binary_name, tag=None, comment=None):
+        self.chain = ebtables_manager.get_chain_name(chain, wrap)
+        self.rule = rule
+        self.wrap = wrap
+        self.top = top
+        self.wrap_name = _binary_name[:16]
+        self.tag = tag
+        self.comment = comment
+
+    def __eq__(self, other):
+        return ((self.chain == other.chain) and
+                (self.rule == other.rule) and
+                (self.top == other.top) and
+                (self.wrap == other.wrap))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.chain, self.rule, self.top, self.wrap))
+
+    def __str__(self):
+        if self.wrap:
+            chain = '%s-%s' % (self.wrap_name, self.chain)
+        else:
+            chain = self.chain
+        return ('-A %s %s' % (chain, self.rule)).strip()
+
+
+def _run_commands(chain, rules, commands):
+    """Apply -D and -I commands to a copy of the rules, like ebtables does."""
+    rules = list(rules)
+    for command in commands:
+        parts = command.split(' ', 3)
+        index = int(parts[2]) - 1
+        if parts[0] == '-D':
+            del rules[index]
+        else:
+            rules.insert(index, ('-A %s %s' % (chain, parts[3])).strip())
+    return rules
+
+
+def _churn(old, fraction):
+    """Delete and insert rules at random positions."""
+    new = list(old)
+    count = max(1, int(len(old) * fraction))
+    for i in range(count):
+        del new[random.randrange(len(new))]
+    for line in _rule_lines(count, prefix='11'):
+        new.insert(random.randrange(len(new) + 1), line)
+    return new
+
+
+def _rewrite_block(old, fraction):
+    """Replace a contiguous block of rules by new ones."""
+    count = max(1, int(len(old) * fraction))
+    start = random.randrange(len(old) - count + 1)
+    return old[:start] + _rule_lines(count, prefix='11') + old[start + count:]
+
+
+def _time(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def benchmark_chain_diff(sizes, ndiff_max, repeat):
+    """Time the diff of one chain against the old difflib.ndiff one."""
+    print('Chain diff, new / ndiff, ndiff skipped above %d rules' % ndiff_max)
+    print('%8s  %-24s  %s' % ('rules', '1% churn', '10% block rewritten'))
+    for size in sizes:
+        old = _rule_lines(size)
+        columns = []
+        for new in (_churn(old, 0.01), _rewrite_block(old, 0.1)):
+            commands = ebtables_manager._generate_chain_diff_ebtables_commands(CHAIN, old, new)
+            if _run_commands(CHAIN, old, commands) != new:
+                raise AssertionError('the chain diff does not reproduce the new rules')
+            times = ['%.4f' % _time(lambda: ebtables_manager._generate_chain_diff_ebtables_commands(
+                CHAIN, old, new), repeat)]
+            if size <= ndiff_max:
+                times.append('%.4f' % _time(lambda: _ndiff_commands(CHAIN, old, new), repeat))
+            else:
+                times.append('-')
+            columns.append(' / '.join(times))
+        print('%8d  %-24s  %s' % (size, columns[0], columns[1]))
+
+
+def _rule_args(count):
+    return [('INPUT', '-p IPv4 --ip-src 10.%d.%d.%d/32 -j DROP' % (
+        i // 65536, i // 256 % 256, i % 256)) for i in range(count)]
+
+
+def _make_rules(rule_class, args):
+    return [rule_class(chain, rule) for chain, rule in args]
+
+
+def _render(rules):
+    # _modify_rules renders every rule of a table twice per apply
+    for i in range(2):
+        [str(rule) for rule in rules]
+
+
+def _lookup(rules, others):
+    rule_set = set(rules)
+    for rule in others:
+        rule in rule_set
+
+
+def _memory(rule_class, count):
+    """Bytes taken by the rules, and by the rules and the lines of an apply."""
+    tracemalloc.start()
+    try:
+        # the rule strings are built for the rules, like the firewall does
+        rules = _make_rules(rule_class, _rule_args(count))
+        rules_size = tracemalloc.get_traced_memory()[0]
+        lines = [str(rule) for rule in rules]
+        lines_size = tracemalloc.get_traced_memory()[0]
+        del lines
+        return rules_size, lines_size
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_rules(count, repeat):
+    """Time the EbtablesRule operations of an apply against the old class."""
+    args = _rule_args(count)
+    print('EbtablesRule with %d rules, new / old' % count)
+    results = []
+    for rule_class in (ebtables_manager.EbtablesRule, _PlainRule):
+        rules = _make_rules(rule_class, args)
+        others = _make_rules(rule_class, args)
+        results.append([
+            '%.3fs' % _time(lambda: _make_rules(rule_class, args), repeat),
+            '%.3fs' % _time(lambda: _render(rules), repeat),
+            '%.3fs' % _time(lambda: _lookup(rules, others), repeat),
+        ] + ['%.1fMB' % (size / 1024.0 / 1024) if tracemalloc else '-'
+             for size in (_memory(rule_class, count) if tracemalloc else (None, None))])
+    names = ['construction', 'two render passes', 'set build and lookups', 'memory of the rules',
+             'with the lines of an apply']
+    for name, new, old in zip(names, *results):
+        print('  %-28s %s / %s' % (name, new, old))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000, 10000, 50000],
+                        help='Numbers of rules to run with')
+    parser.add_argument('--ndiff-max', type=int, default=1000,
+                        help='Largest number of rules to time the old ndiff diff with, it takes '
+                             'minutes from a few thousands on')
+    parser.add_argument('--rules', type=int, default=100000,
+                        help='Number of rules to time the EbtablesRule operations with')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of each measurement, the best one is printed')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random rule changes')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    benchmark_chain_diff(args.sizes, args.ndiff_max, args.repeat)
+    print()
+    benchmark_rules(args.rules, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Benchmark of the isoflat rule lookups of the server.
+
+Run it with ``tox -e benchmark-db`` or, in an environment with neutron
+installed, ``python tools/benchmark_rule_lookups.py``. It fills an empty
+database, SQLite in memory by default, and times each lookup with and
+without the isoflatrules indexes. Times are the average of --lookups
+runs, in milliseconds.
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import timeit
+
+# all the models, for their relationships and tables
+from neutron.db.migration.models import head  # noqa
+from neutron.db.models.segment import NetworkSegment
+from neutron.db.models_v2 import Network, Subnet
+from neutron_lib.db import model_base
+from oslo_utils import uuidutils
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from neutron_isoflat.db.isoflat_db import IsoflatDbMixin
+from neutron_isoflat.db.models.isoflat import IsoflatRule
+
+PROJECT_ID = 'benchmark'
+
+
+class _Context(object):
+    """The part of a neutron context the lookups use."""
+
+    def __init__(self, session):
+        self.session = session
+
+
+def _add_network(session, segment, cidrs=()):
+    network_id = uuidutils.generate_uuid()
+    session.add(Network(id=network_id, project_id=PROJECT_ID, name=network_id,
+                        status='ACTIVE', admin_state_up=True))
+    session.add(NetworkSegment(id=uuidutils.generate_uuid(), network_id=network_id,
+                               segment_index=0, is_dynamic=False, **segment))
+    for cidr in cidrs:
+        session.add(Subnet(id=uuidutils.generate_uuid(), project_id=PROJECT_ID,
+                           network_id=network_id, ip_version=4, cidr=cidr, enable_dhcp=False))
+    return network_id
+
+
+def _fill(session, rules, flat_networks, remote_networks):
+    """
+    Add a flat network to each of flat_networks physical networks, VXLAN
+    networks with two subnets each to take remote IPs from, and rules
+    spread over the flat networks, half of them with a remote network.
+    """
+    with session.begin():
+        flat_network_ids = [_add_network(session, {'network_type': 'flat',
+                                                   'physical_network': 'physnet%d' % i})
+                            for i in range(flat_networks)]
+        remote_network_ids = [
+            _add_network(session, {'network_type': 'vxlan', 'segmentation_id': 1000 + i},
+                         ['10.%d.%d.0/24' % (i // 128, i % 128 * 2),
+                          '10.%d.%d.0/24' % (i // 128, i % 128 * 2 + 1)])
+            for i in range(remote_networks)]
+    for start in range(0, rules, 10000):
+        with session.begin():
+            for i in range(start, min(start + 10000, rules)):
+                remote_network_id = remote_network_ids[i % remote_networks] if i % 2 else None
+                session.add(IsoflatRule(id=uuidutils.generate_uuid(), project_id=PROJECT_ID,
+                                        network_id=flat_network_ids[i % flat_networks],
+                                        direction='ingress', ethertype='IPv4',
+                                        remote_network_id=remote_network_id))
+        session.expunge_all()
+    return flat_network_ids, remote_network_ids
+
+
+def _time(session, lookup, args, lookups):
+    def run():
+        lookup(_Context(session), random.choice(args))
+        session.expunge_all()
+
+    return timeit.timeit(run, number=lookups) / lookups * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--connection', default='sqlite://',
+                        help='SQLAlchemy URL of an empty database to fill')
+    parser.add_argument('--rules', type=int, default=100000,
+                        help='Number of rules')
+    parser.add_argument('--flat-networks', type=int, default=200,
+                        help='Number of flat networks, each on its own physical network')
+    parser.add_argument('--remote-networks', type=int, default=2000,
+                        help='Number of VXLAN networks the rules take remote IPs from')
+    parser.add_argument('--lookups', type=int, default=200,
+                        help='Runs of each lookup, the average is printed')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the looked up networks')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    engine = sa.create_engine(args.connection)
+    model_base.BASEV2.metadata.create_all(engine)
+    session = orm.sessionmaker(bind=engine, autocommit=True)()
+    flat_network_ids, remote_network_ids = _fill(
+        session, args.rules, args.flat_networks, args.remote_networks)
+    physical_networks = ['physnet%d' % i for i in range(args.flat_networks)]
+
+    lookups = [
+        ('rules by network', lambda context, network_id: IsoflatDbMixin._get_rules_to_delete(
+            context, network_id=network_id), flat_network_ids),
+        ('rules by physical network', IsoflatDbMixin._get_rules_by_physical_network,
+         physical_networks),
+        ('rules by remote network', IsoflatDbMixin._get_rules_by_remote_network,
+         remote_network_ids),
+    ]
+    indexes = list(IsoflatRule.__table__.indexes)
+    print('%d rules, %d flat networks, %d remote networks, ms per lookup' % (
+        args.rules, args.flat_networks, args.remote_networks))
+    print('  %-28s %10s %10s' % ('lookup', 'no indexes', 'indexes'))
+    results = dict((name, []) for name, lookup, lookup_args in lookups)
+    for indexed in (False, True):
+        for index in indexes:
+            if indexed:
+                index.create(engine)
+            else:
+                index.drop(engine)
+        for name, lookup, lookup_args in lookups:
+            results[name].append(_time(session, lookup, lookup_args, args.lookups))
+    for name, lookup, lookup_args in lookups:
+        print('  %-28s %10.2f %10.2f' % ((name,) + tuple(results[name])))
+
+
+if __name__ == '__main__':
+    main()